@@ -1,8 +1,13 @@
+import copy
+import multiprocessing
 import optparse
 import sys
-import math
-from collections import defaultdict
 import os
+import time
+import bias
+import corpus
+import em
+import ttable
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--data", dest="train", default="data/hansards",
@@ -19,6 +24,10 @@ optparser.add_option("-s", "--sigma", dest="sigma", default=0.3, type="float",
                      help="Diagonal bias parameter")
 optparser.add_option("-t", "--threshold", dest="threshold", default=0.01, type="float",
                      help="Alignment threshold")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int",
+                     help="Number of processes for the E-step (default=1)")
+optparser.add_option("-c", "--cache", dest="cache", default=None,
+                     help="Compiled corpus cache file, '' to disable (default=<data>.<f>-<e>.bitext)")
 
 optparser.add_option("--variants", dest="variants",
                      default="full,minus_len,minus_pos,diag_only,ibm1",
@@ -27,41 +36,25 @@ optparser.add_option("--outdir", dest="outdir", default=".",
                      help="Directory to save .a files (default=.)")
 optparser.add_option("--prefix", dest="prefix", default="ablation_",
                      help="Filename prefix (default=ablation_)")
+optparser.add_option("-j", "--jobs", dest="jobs", default=None, type="int",
+                     help="Number of variants trained in parallel, each with a single E-step process "
+                          "(default=number of cores, or 1 with -w)")
+optparser.add_option("--checkpoint-dir", dest="checkpoint_dir", default=None,
+                     help="Directory to save each variant's t-table as <prefix><variant>.npz, "
+                          "and to load warm-start sources from")
+optparser.add_option("--warm-start", dest="warm_start", default="",
+                     help="Comma-separated variant=source pairs, e.g. full=ibm1: start the variant "
+                          "from the source's trained t-table instead of uniform. The source is "
+                          "trained first if it is in --variants, else read from --checkpoint-dir")
 
 (opts, _) = optparser.parse_args()
 
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
+cache = "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english) if opts.cache is None else opts.cache
 
 sys.stderr.write("Loading parallel corpus...\n")
-bitext = [[sent.strip().split() for sent in pair]
-          for pair in zip(open(f_data), open(e_data))][:opts.num_sents]
-
-def diag_bias(i, j_eff, f_len, e_len, sigma):
-    if f_len <= 1 or e_len <= 1:
-        return 1.0
-    ni = i / (f_len - 1.0)
-    nj = j_eff / (e_len - 1.0)
-    distance = abs(ni - nj)
-    return math.exp(-(distance ** 2) / (2.0 * sigma ** 2))
-
-def pos_bias(i, j_eff, f_len, e_len):
-    if f_len <= 1 or e_len <= 1:
-        return 1.0
-    ni = i / (f_len - 1.0)
-    nj = j_eff / (e_len - 1.0)
-    return math.exp(-2.0 * abs(ni - nj))
-
-def len_bias(f_len, e_len):
-    ratio = f_len / max(e_len, 1)
-    return 1.0 if 0.5 <= ratio <= 2.0 else 0.5
-
-def combined_bias(i, j_eff, f_len, e_len, sigma, use_diag, use_pos, use_len):
-    b = 1.0
-    if use_diag: b *= diag_bias(i, j_eff, f_len, e_len, sigma)
-    if use_pos:  b *= pos_bias(i, j_eff, f_len, e_len)
-    if use_len:  b *= len_bias(f_len, e_len)
-    return b
+(f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache)
 
 VARIANTS = {
     "full":       (True,  True,  True ),
@@ -71,87 +64,101 @@ VARIANTS = {
     "ibm1":       (False, False, False),
 }
 
-def train_and_decode(use_diag, use_pos, use_len):
-    f_vocab, e_vocab = set(), set()
-    for (f, e) in bitext:
-        f_vocab.update(f); e_vocab.update(e)
-    t = defaultdict(lambda: defaultdict(float))
-    invE = 1.0 / float(len(e_vocab))
-    for f in f_vocab:
-        for e in e_vocab:
-            t[f][e] = invE
-
-    # EM
-    for _ in range(opts.iterations):
-        count_fe = defaultdict(lambda: defaultdict(float))
-        count_e  = defaultdict(float)
-
-        for (f, e) in bitext:
-            e_with_null = ['NULL'] + e
-            f_len, e_len = len(f), len(e)
-
-            for i, f_word in enumerate(f):
-                total = 0.0
-                for j, e_word in enumerate(e_with_null):
-                    if j == 0:
-                        w = t[f_word][e_word]
-                    else:
-                        cb = combined_bias(i, j-1, f_len, e_len, opts.sigma, use_diag, use_pos, use_len)
-                        w = t[f_word][e_word] * cb
-                    total += w
+def bias_table(use_diag, use_pos, use_len):
+    if not (use_diag or use_pos or use_len):
+        return None
+    return bias.BiasTable(opts.sigma, use_diag, use_pos, use_len, flat_short=True)
 
-                if total <= 0.0:
-                    continue
+def checkpoint_file(name):
+    return os.path.join(opts.checkpoint_dir, f"{opts.prefix}{name}.npz")
 
-                for j, e_word in enumerate(e_with_null):
-                    if j == 0:
-                        expected = t[f_word][e_word] / total
-                    else:
-                        cb = combined_bias(i, j-1, f_len, e_len, opts.sigma, use_diag, use_pos, use_len)
-                        expected = (t[f_word][e_word] * cb) / total
-                    count_fe[f_word][e_word] += expected
-                    count_e[e_word] += expected
+def train_and_decode(name, init_prob=None):
+    """ Train one variant from the shared t-table skeleton and chunks, which
+    forked workers inherit, optionally warm-started from init_prob """
+    start = time.time()
+    t = copy.copy(skeleton)
+    if init_prob is not None:
+        t.prob = init_prob.copy()
+    table = tables[VARIANTS[name]]
 
-        # M-step
-        new_t = defaultdict(lambda: defaultdict(float))
-        for f_word in count_fe:
-            for e_word in count_fe[f_word]:
-                denom = count_e[e_word]
-                if denom > 0.0:
-                    new_t[f_word][e_word] = count_fe[f_word][e_word] / denom
-        t = new_t
+    # EM
+    em.train(t, chunks, opts.iterations, table, workers)
 
     # Decode
     lines = []
-    for (f, e) in bitext:
-        f_len, e_len = len(f), len(e)
-        out = []
-        for i, f_word in enumerate(f):
-            best_alignment = 0
-            best_score = t[f_word]['NULL']
-            for j, e_word in enumerate(e):
-                cb = combined_bias(i, j, f_len, e_len, opts.sigma, use_diag, use_pos, use_len)
-                score = t[f_word][e_word] * cb
-                if score > best_score:
-                    best_score = score
-                    best_alignment = j
-            if best_score > opts.threshold:
-                out.append(f"{i}-{best_alignment}")
-        lines.append(" ".join(out))
-    return "\n".join(lines)
+    for links in em.viterbi(t, chunks, table, opts.threshold):
+        lines.append(" ".join(f"{i}-{j}" for (i, j) in links))
+    if opts.checkpoint_dir:
+        t.save(checkpoint_file(name))
+    return name, t.prob, "\n".join(lines), time.time() - start
 
 names = [v.strip() for v in opts.variants.split(",") if v.strip() in VARIANTS]
 if not names:
     sys.stderr.write("[ERR] No valid variants specified.\n")
     sys.exit(1)
-
+sources = dict(pair.strip().split("=", 1) for pair in opts.warm_start.split(",") if pair.strip())
+for (name, source) in sources.items():
+    if name not in VARIANTS or source not in VARIANTS or name == source:
+        sys.stderr.write(f"[ERR] Invalid warm start {name}={source}.\n")
+        sys.exit(1)
+    if source not in names and not opts.checkpoint_dir:
+        sys.stderr.write(f"[ERR] Warm start {name}={source} needs {source} in --variants or a --checkpoint-dir.\n")
+        sys.exit(1)
+
+# Shared state, built once for every variant: the t-table layout, the chunked
+# corpus, and the bias matrix of every sentence shape for each bias setting
 os.makedirs(opts.outdir, exist_ok=True)
-sys.stderr.write(f"Running variants: {', '.join(names)}\n")
-for name in names:
-    use_diag, use_pos, use_len = VARIANTS[name]
-    sys.stderr.write(f"[Run] {name}  n={opts.num_sents}  iters={opts.iterations}  sigma={opts.sigma}  thr={opts.threshold}\n")
-    alignment = train_and_decode(use_diag, use_pos, use_len)
-    outfile = os.path.join(opts.outdir, f"{opts.prefix}{name}.a")
-    with open(outfile, "w", encoding="utf-8") as f:
-        f.write(alignment + "\n")
-    sys.stderr.write(f"  -> wrote {outfile}\n")
+if opts.checkpoint_dir:
+    os.makedirs(opts.checkpoint_dir, exist_ok=True)
+# E-step workers cannot be nested inside the pool of variants
+if opts.jobs is None:
+    opts.jobs = 1 if opts.workers > 1 else os.cpu_count()
+jobs = max(min(opts.jobs, len(names)), 1)
+workers = opts.workers if jobs == 1 else 1
+if workers != opts.workers:
+    sys.stderr.write(f"[WARN] -w {opts.workers} ignored: the E-step runs in 1 process per job with -j {jobs}.\n")
+skeleton = ttable.TTable(bitext, len(e_vocab))
+chunks = em.prepare(bitext, skeleton, workers=workers)
+tables = {}
+for settings in set(VARIANTS[name] for name in names):
+    tables[settings] = bias_table(*settings)
+    em.reserve(tables[settings], chunks)
+    if tables[settings] is not None:
+        for chunk in chunks:
+            for (f_len, e_len, _) in chunk.groups:
+                tables[settings](f_len, e_len)
+
+sys.stderr.write(f"Running variants: {', '.join(names)} with {jobs} job(s)\n")
+trained = {}
+pending = list(names)
+pool = multiprocessing.get_context("fork").Pool(jobs) if jobs > 1 else None
+while pending:
+    # A variant is ready once its warm-start source (if any) has been trained
+    ready = [name for name in pending if sources.get(name) not in pending]
+    if not ready:
+        sys.stderr.write(f"[ERR] Circular warm starts among: {', '.join(pending)}.\n")
+        sys.exit(1)
+    tasks = []
+    for name in ready:
+        init_prob = None
+        if name in sources:
+            if sources[name] in trained:
+                init_prob = trained[sources[name]]
+            else:
+                init = copy.copy(skeleton)
+                init.restore(checkpoint_file(sources[name]))
+                init_prob = init.prob
+        sys.stderr.write(f"[Run] {name}  n={opts.num_sents}  iters={opts.iterations}  sigma={opts.sigma}  thr={opts.threshold}"
+                         + (f"  warm={sources[name]}" if name in sources else "") + "\n")
+        tasks.append((name, init_prob))
+    results = pool.starmap(train_and_decode, tasks) if pool else [train_and_decode(*task) for task in tasks]
+    for (name, prob, alignment, seconds) in results:
+        trained[name] = prob
+        outfile = os.path.join(opts.outdir, f"{opts.prefix}{name}.a")
+        with open(outfile, "w", encoding="utf-8") as f:
+            f.write(alignment + "\n")
+        sys.stderr.write(f"  -> wrote {outfile} ({seconds:.1f}s)\n")
+    pending = [name for name in pending if name not in ready]
+if pool:
+    pool.close()
+    pool.join()
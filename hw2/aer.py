@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# In-process alignment error rate, computed exactly like score-alignments
+# (which is now a thin command-line wrapper around this module).
+#
+# The gold alignments are read once into sorted arrays of packed link keys;
+# each gold line holds sure links i-j and possible links i?j. Candidate links
+# are packed the same way, so intersecting them with the gold standard is a
+# vectorized sorted-array membership test, and any number of candidate
+# alignments can be scored in a single call. As in score-alignments, only as
+# many candidate sentences as there are gold lines are scored, and repeated
+# links within a sentence count once. Example API usage:
+#
+# gold = aer.Gold("data/hansards.a")
+# (precision, recall, error) = gold.score(alignment)  # one list of (i, j) per sentence
+# scores = gold.score_many([alignment1, alignment2])  # rows of (precision, recall, AER)
+import numpy as np
+
+# A link (k, i, j) of sentence k is packed into k << 32 | i << 16 | j
+POSITION_BITS = 16
+
+def pack(sentences, links):
+  """ Keys of an (n, 2) array of (i, j) links belonging to the given sentences """
+  return (np.asarray(sentences, dtype=np.int64) << (2 * POSITION_BITS)) | (links[:, 0] << POSITION_BITS) | links[:, 1]
+
+def parse(line, separator="-"):
+  """ The (n, 2) array of links i<separator>j on one line of an alignment file """
+  tokens = [x for x in line.split() if separator in x]
+  return np.array(" ".join(tokens).replace(separator, " ").split(), dtype=np.int64).reshape(-1, 2)
+
+def member(keys, table):
+  """ Which keys occur in the sorted array table """
+  if not len(table):
+    return np.zeros(len(keys), dtype=bool)
+  s = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+  return table[s] == keys
+
+class Gold:
+  def __init__(self, filename):
+    (sure, possible) = ([], [])
+    for line in open(filename):
+      sure.append(parse(line, "-"))
+      possible.append(parse(line, "?"))
+    self.size = len(sure)
+    self.sure = self.keys(sure)
+    self.possible = self.keys(possible)
+    # sure_total[m] is the number of sure links in the first m sentences
+    per_sentence = np.bincount(self.sure >> (2 * POSITION_BITS), minlength=self.size)
+    self.sure_total = np.concatenate(([0], np.cumsum(per_sentence)))
+
+  def __len__(self):
+    return self.size
+
+  def keys(self, alignment):
+    """ Sorted unique keys of the first len(self) sentences of an alignment,
+    given as one collection of (i, j) links per sentence """
+    sentences = [np.asarray(links, dtype=np.int64).reshape(-1, 2) for (_, links) in zip(range(self.size), alignment)]
+    if not sentences:
+      return np.zeros(0, dtype=np.int64)
+    lengths = [len(links) for links in sentences]
+    return np.unique(pack(np.repeat(np.arange(len(sentences)), lengths), np.concatenate(sentences)))
+
+  def links(self, k):
+    """ The (sure, possible) sets of (i, j) links of gold sentence k """
+    def unpack(table):
+      lo = np.searchsorted(table, k << (2 * POSITION_BITS))
+      hi = np.searchsorted(table, (k + 1) << (2 * POSITION_BITS))
+      mask = (1 << POSITION_BITS) - 1
+      return set((int(key >> POSITION_BITS & mask), int(key & mask)) for key in table[lo:hi])
+    return unpack(self.sure), unpack(self.possible)
+
+  def score(self, alignment):
+    """ (precision, recall, AER) of one alignment """
+    return tuple(float(x) for x in self.score_many([alignment])[0])
+
+  def score_many(self, alignments):
+    """ An (n, 3) array with the (precision, recall, AER) of each alignment """
+    size_a = np.zeros(len(alignments))
+    size_s = np.zeros(len(alignments))
+    size_a_and_s = np.zeros(len(alignments))
+    size_a_and_p = np.zeros(len(alignments))
+    for (c, alignment) in enumerate(alignments):
+      alignment = list(alignment)
+      keys = self.keys(alignment)
+      in_sure = member(keys, self.sure).sum()
+      size_a[c] = len(keys)
+      size_s[c] = self.sure_total[min(len(alignment), self.size)]
+      size_a_and_s[c] = in_sure
+      size_a_and_p[c] = member(keys, self.possible).sum() + in_sure
+    precision = np.divide(size_a_and_p, size_a, out=np.zeros(len(alignments)), where=size_a > 0)
+    recall = np.divide(size_a_and_s, size_s, out=np.zeros(len(alignments)), where=size_s > 0)
+    total = size_a + size_s
+    aer = 1 - np.divide(size_a_and_s + size_a_and_p, total, out=np.zeros(len(alignments)), where=total > 0)
+    return np.stack([precision, recall, aer], axis=1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Positional bias tables for the IBM Model 1 family of aligners.
+#
+# The diagonal, position and length biases only depend on (i, j, f_len,
+# e_len, sigma), so instead of calling math.exp for every cell of every
+# sentence in every EM iteration, a BiasTable builds the whole
+# (f_len, e_len) matrix the first time that shape is asked for and keeps it
+# in an LRU cache. The distances are computed with NumPy, but every cell goes
+# through math.exp, so the biases are the exact values the scalar loops used. em.train() and em.best() reserve room in
+# the cache for every shape of their chunks, so the matrices are built once
+# per run. The same matrices feed the E-step and the Viterbi decode in em.py.
+# Example API usage:
+#
+# table = bias.BiasTable(sigma=0.3, diag=True, pos=True, length=True)
+# em.train(t, chunks, iterations, table)
+# table(f_len, e_len)[i, j]  # bias of linking French word i to English word j
+import math
+from functools import lru_cache
+import numpy as np
+
+# math.exp over an array, cell by cell; np.exp can differ from it in the last bit
+exp = np.frompyfunc(math.exp, 1, 1)
+
+class BiasTable:
+  """ Cached product of the enabled bias terms:
+
+  - diag: exp(-d^2 / (2 sigma^2)), a Gaussian preference for the diagonal
+  - pos: exp(-2 d), a sharper exponential preference for the diagonal
+  - length: 0.5 when one sentence is more than twice as long as the other
+
+  where d = |i / (f_len - 1) - j / (e_len - 1)| is the distance between the
+  relative positions of the two words. With flat_short, sentences of a single
+  word get no diag or pos preference at all (the convention of ablation.py).
+  Matrices are read-only and shared between callers. With factors, a table
+  returns the tuple of the enabled terms instead of their product, for the
+  scripts that multiplied t by each term in turn, ((t * diag) * pos) * len,
+  since floating-point products depend on their order """
+  def __init__(self, sigma, diag=True, pos=False, length=False, flat_short=False, cache_size=4096, factors=False):
+    self.sigma = sigma
+    self.diag = diag
+    self.pos = pos
+    self.length = length
+    self.flat_short = flat_short
+    self.factors = factors
+    self.cache_size = cache_size
+    self.matrix = lru_cache(maxsize=cache_size)(self.build)
+
+  def reserve(self, shapes):
+    """ Grow the cache to hold this many shapes; growing empties it """
+    if shapes > self.cache_size:
+      self.cache_size = shapes
+      self.matrix = lru_cache(maxsize=shapes)(self.build)
+
+  def settings(self):
+    """ The constructor arguments that determine the matrices """
+    return {"sigma": self.sigma, "diag": self.diag, "pos": self.pos,
+            "length": self.length, "flat_short": self.flat_short}
+
+  def __call__(self, f_len, e_len):
+    return self.matrix(f_len, e_len)
+
+  def terms(self, f_len, e_len):
+    """ The enabled bias terms in the order they are multiplied, the length
+    term as a scalar """
+    len_bias = 1.0 if 0.5 <= f_len / max(e_len, 1) <= 2.0 else 0.5
+    flat = self.flat_short and (f_len <= 1 or e_len <= 1)
+    distance = np.abs(np.arange(f_len)[:, None] / max(f_len - 1, 1) - np.arange(e_len)[None, :] / max(e_len - 1, 1))
+    terms = []
+    if self.diag and not flat:
+      terms.append(exp(-(distance ** 2) / (2 * self.sigma ** 2)).astype(float))
+    if self.pos and not flat:
+      terms.append(exp(-distance * 2).astype(float))
+    if self.length:
+      terms.append(len_bias)
+    for term in terms:
+      if isinstance(term, np.ndarray):
+        term.flags.writeable = False
+    return terms
+
+  def build(self, f_len, e_len):
+    terms = self.terms(f_len, e_len)
+    if self.factors:
+      return tuple(terms)
+    matrix = np.ones((f_len, e_len))
+    for term in terms:
+      matrix *= term
+    matrix.flags.writeable = False
+    return matrix
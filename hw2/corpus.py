@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# Integer-id bitext shared by the word aligners.
+#
+# Sentence pairs are read lazily and stop at num_sents, and every token is
+# interned on the fly, so the corpus is stored once as two flat int32 arrays
+# of word ids plus sentence offsets instead of a list of Python strings.
+#
+# With a cache file, the whole corpus is compiled once into a versioned binary
+# image (vocabularies plus the packed id arrays) keyed by a hash of the source
+# files' paths, sizes and modification times. Later runs memory-map the image
+# instead of re-parsing the text, and take the first num_sents pairs from it.
+# Since ids are handed out in order of first occurrence, the vocabulary of
+# those pairs is just a prefix of the full one. Example API usage:
+#
+# (f_vocab, e_vocab, bitext) = corpus.read("data/hansards.f", "data/hansards.e", 1000,
+#                                          cache="data/hansards.f-e.bitext")
+# (f, e) = bitext[0]  # int32 id arrays of the first sentence pair
+# f_vocab[f[0]]       # back to the French word
+from array import array
+from itertools import islice
+import hashlib
+import optparse
+import os
+import sys
+import numpy as np
+import image
+
+# The English vocabulary always reserves id 0 for the empty word
+NULL = "NULL"
+NULL_ID = 0
+
+class Vocab:
+  """ Maps words to consecutive integer ids and back """
+  def __init__(self, words=()):
+    self.index = {}
+    self.words = []
+    for word in words:
+      self.id(word)
+
+  def id(self, word):
+    """ Return the id of word, assigning the next free id if it is new """
+    i = self.index.get(word)
+    if i is None:
+      i = self.index[word] = len(self.words)
+      self.words.append(word)
+    return i
+
+  def __len__(self):
+    return len(self.words)
+
+  def __getitem__(self, i):
+    return self.words[i]
+
+class Corpus:
+  """ Sentence pair k is (f_ids[f_offsets[k]:f_offsets[k+1]],
+  e_ids[e_offsets[k]:e_offsets[k+1]]). Slicing a Corpus gives a view that
+  shares the id arrays """
+  def __init__(self, f_ids, f_offsets, e_ids, e_offsets):
+    self.f_ids = f_ids
+    self.f_offsets = f_offsets
+    self.e_ids = e_ids
+    self.e_offsets = e_offsets
+
+  def __len__(self):
+    return len(self.f_offsets) - 1
+
+  def __getitem__(self, k):
+    if isinstance(k, slice):
+      (start, stop, _) = k.indices(len(self))
+      stop = max(start, stop)
+      return Corpus(self.f_ids, self.f_offsets[start:stop + 1], self.e_ids, self.e_offsets[start:stop + 1])
+    return (self.f_ids[self.f_offsets[k]:self.f_offsets[k + 1]],
+            self.e_ids[self.e_offsets[k]:self.e_offsets[k + 1]])
+
+  def __iter__(self):
+    return (self[k] for k in range(len(self)))
+
+  def f_lens(self):
+    return np.diff(self.f_offsets)
+
+  def e_lens(self):
+    return np.diff(self.e_offsets)
+
+  def shapes(self):
+    """ Group the sentence pairs by (f_len, e_len). Yields (f_len, e_len,
+    pairs, f, e) where pairs are increasing pair indices, f the (n, f_len)
+    French ids and e the (n, e_len + 1) English ids with NULL in column 0 """
+    (f_lens, e_lens) = (self.f_lens(), self.e_lens())
+    order = np.lexsort((e_lens, f_lens))
+    bounds = np.flatnonzero(np.diff(f_lens[order]) | np.diff(e_lens[order])) + 1
+    for pairs in np.split(order, bounds) if len(order) else []:
+      pairs = np.sort(pairs)
+      (f_len, e_len) = (int(f_lens[pairs[0]]), int(e_lens[pairs[0]]))
+      f = self.f_ids[self.f_offsets[pairs][:, None] + np.arange(f_len)]
+      e = self.e_ids[self.e_offsets[pairs][:, None] + np.arange(e_len)]
+      yield (f_len, e_len, pairs, f, np.pad(e, ((0, 0), (1, 0)), constant_values=NULL_ID))
+
+def build(pairs, f_vocab=None, e_vocab=None, frozen=False):
+  """ Intern an iterable of (french, english) token lists into a Corpus.
+  Returns (f_vocab, e_vocab, corpus); e_vocab[NULL_ID] is NULL. With frozen,
+  the given vocabularies are left as they are and unknown words get the id
+  len(vocab), which no trained parameter is indexed by """
+  f_vocab = f_vocab if f_vocab is not None else Vocab()
+  e_vocab = e_vocab if e_vocab is not None else Vocab([NULL])
+  if frozen:
+    (f_unk, e_unk) = (len(f_vocab), len(e_vocab))
+    f_id = lambda word: f_vocab.index.get(word, f_unk)
+    e_id = lambda word: e_vocab.index.get(word, e_unk)
+  else:
+    (f_id, e_id) = (f_vocab.id, e_vocab.id)
+  (f_ids, e_ids) = (array("i"), array("i"))
+  (f_offsets, e_offsets) = (array("q", [0]), array("q", [0]))
+  for (f, e) in pairs:
+    f_ids.extend(map(f_id, f))
+    e_ids.extend(map(e_id, e))
+    f_offsets.append(len(f_ids))
+    e_offsets.append(len(e_ids))
+  arrays = [np.frombuffer(a, dtype=np.int32 if a.typecode == "i" else np.int64)
+            for a in (f_ids, f_offsets, e_ids, e_offsets)]
+  return f_vocab, e_vocab, Corpus(*arrays)
+
+# The binary image (see image.py) holds the vocabularies and the packed id
+# arrays. Bump VERSION whenever the meaning of the arrays changes
+MAGIC = b"hw2bitext"
+VERSION = 1
+
+def pack_words(vocab):
+  """ A Vocab as a uint8 array of newline-separated UTF-8 words """
+  return np.frombuffer("\n".join(vocab.words).encode("utf-8"), dtype=np.uint8)
+
+def unpack_words(a):
+  """ The Vocab packed by pack_words() """
+  return Vocab(a.tobytes().decode("utf-8").split("\n") if len(a) else [])
+
+def source_key(*paths):
+  """ Hash identifying the current contents of the source files """
+  h = hashlib.sha1(b"%d" % VERSION)
+  for path in paths:
+    st = os.stat(path)
+    h.update(("%s\0%d\0%d\0" % (os.path.abspath(path), st.st_size, st.st_mtime_ns)).encode("utf-8"))
+  return h.hexdigest()
+
+def save(path, f_vocab, e_vocab, bitext, key):
+  """ Write a corpus and its vocabularies as a binary image, atomically """
+  image.save(path, MAGIC, {"version": VERSION, "key": key},
+             {"f_ids": bitext.f_ids, "f_offsets": bitext.f_offsets,
+              "e_ids": bitext.e_ids, "e_offsets": bitext.e_offsets,
+              "f_words": pack_words(f_vocab), "e_words": pack_words(e_vocab)})
+
+def load(path, key=None):
+  """ Memory-map a binary image written by save(). Returns (f_vocab, e_vocab,
+  corpus), or None if the file is missing, of another version, or was
+  compiled from sources other than key """
+  loaded = image.load(path, MAGIC)
+  if loaded is None:
+    return None
+  (header, arrays) = loaded
+  if header.get("version") != VERSION or (key is not None and header.get("key") != key):
+    return None
+  bitext = Corpus(arrays["f_ids"], arrays["f_offsets"], arrays["e_ids"], arrays["e_offsets"])
+  return unpack_words(arrays["f_words"]), unpack_words(arrays["e_words"]), bitext
+
+def head(f_vocab, e_vocab, bitext, num_sents):
+  """ The first num_sents pairs of a corpus, with vocabularies cut down to the
+  words occurring in them """
+  if num_sents >= len(bitext):
+    return f_vocab, e_vocab, bitext
+  bitext = bitext[:max(num_sents, 0)]
+  f_used = bitext.f_ids[:bitext.f_offsets[-1]]
+  e_used = bitext.e_ids[:bitext.e_offsets[-1]]
+  f_size = int(f_used.max()) + 1 if len(f_used) else 0
+  e_size = max(int(e_used.max()) if len(e_used) else NULL_ID, NULL_ID) + 1
+  return Vocab(f_vocab.words[:f_size]), Vocab(e_vocab.words[:e_size]), bitext
+
+def reindex(f_vocab, e_vocab, bitext, to_f_vocab, to_e_vocab):
+  """ The same corpus with the ids of to_f_vocab and to_e_vocab, which hand
+  out new ids to words they do not know yet """
+  f_map = np.array([to_f_vocab.id(word) for word in f_vocab.words], dtype=np.int32)
+  e_map = np.array([to_e_vocab.id(word) for word in e_vocab.words], dtype=np.int32)
+  return Corpus(f_map[bitext.f_ids[:bitext.f_offsets[-1]]], bitext.f_offsets,
+                e_map[bitext.e_ids[:bitext.e_offsets[-1]]], bitext.e_offsets)
+
+def read(f_data, e_data, num_sents, cache=None, f_vocab=None, e_vocab=None):
+  """ Read and intern the first num_sents lines of a pair of parallel files,
+  through the binary image cache if one is given. Words are interned into
+  f_vocab and e_vocab (e.g. those of a saved model) when they are given """
+  if not cache:
+    with open(f_data) as f_file, open(e_data) as e_file:
+      lines = islice(zip(f_file, e_file), max(num_sents, 0))
+      return build(((f.split(), e.split()) for (f, e) in lines), f_vocab, e_vocab)
+  key = source_key(f_data, e_data)
+  compiled = load(cache, key)
+  if compiled is None:
+    compiled = read(f_data, e_data, sys.maxsize)
+    try:
+      save(cache, *compiled, key)
+    except OSError as e:
+      sys.stderr.write("WARNING: could not write corpus cache %s: %s\n" % (cache, e))
+  compiled = head(*compiled, num_sents)
+  if f_vocab is None and e_vocab is None:
+    return compiled
+  (f_vocab, e_vocab) = (f_vocab if f_vocab is not None else Vocab(), e_vocab if e_vocab is not None else Vocab([NULL]))
+  return f_vocab, e_vocab, reindex(*compiled, f_vocab, e_vocab)
+
+if __name__ == "__main__":
+  optparser = optparse.OptionParser(usage="%prog [options]\nCompile a bitext into the binary cache read by the aligners")
+  optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
+  optparser.add_option("-e", "--english", dest="english", default="e", help="Suffix of English filename (default=e)")
+  optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix of French filename (default=f)")
+  optparser.add_option("-c", "--cache", dest="cache", default=None, help="Cache file (default=<data>.<f>-<e>.bitext)")
+  (opts, _) = optparser.parse_args()
+  cache = opts.cache or "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english)
+  (f_vocab, e_vocab, bitext) = read("%s.%s" % (opts.train, opts.french), "%s.%s" % (opts.train, opts.english), sys.maxsize, cache)
+  sys.stderr.write("%s: %d sentence pairs, %d French and %d English words\n" % (cache, len(bitext), len(f_vocab), len(e_vocab)))
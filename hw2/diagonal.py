@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 import optparse
 import sys
-import math
-from collections import defaultdict
+import bias
+import corpus
+import em
+import ttable
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
@@ -11,89 +13,43 @@ optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=100000000000, type="int", help="Number of sentences to use for training and alignment")
 optparser.add_option("-i", "--iterations", dest="iterations", default=5, type="int", help="Number of EM iterations (default=5)")
 optparser.add_option("-s", "--sigma", dest="sigma", default=1.0, type="float", help="Diagonal bias parameter (default=1.0)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of processes for the E-step (default=1)")
+optparser.add_option("-c", "--cache", dest="cache", default=None, help="Compiled corpus cache file, '' to disable (default=<data>.<f>-<e>.bitext)")
+optparser.add_option("--save-model", dest="save_model", default=None, help="Save the trained model to this file")
+optparser.add_option("--load-model", dest="load_model", default=None, help="Align with a saved model instead of training one")
+optparser.add_option("--float32", dest="float32", default=False, action="store_true", help="Save model probabilities as float32")
+optparser.add_option("--top-k", dest="top_k", default=None, type="int", help="Save only the k most probable English words of each French word")
 (opts, _) = optparser.parse_args()
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
+cache = "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english) if opts.cache is None else opts.cache
 
-sys.stderr.write("Training diagonal model...")
-bitext = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))][:opts.num_sents]
+if opts.load_model:
+  sys.stderr.write("Loading diagonal model...")
+  (f_vocab, e_vocab, t, settings) = ttable.load_model(opts.load_model)
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache, f_vocab, e_vocab)
+  diagonal_bias = bias.BiasTable(**settings) if settings else None
+  chunks = em.prepare(bitext, t)
+else:
+  sys.stderr.write("Training diagonal model...")
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache)
 
-# initialize vocabulary and translation probabilities
-f_vocab = set()
-e_vocab = set()
-for (f, e) in bitext:
-  f_vocab.update(f)
-  e_vocab.update(e)
+  # Gaussian preference for links near the diagonal, cached per sentence shape
+  diagonal_bias = bias.BiasTable(opts.sigma, diag=True)
 
-t = defaultdict(lambda: defaultdict(float))
-for f in f_vocab:
-  for e in e_vocab:
-    t[f][e] = 1.0 / len(e_vocab)
+  # initialize translation probabilities (implicitly uniform)
+  t = ttable.TTable(bitext, len(e_vocab))
+  chunks = em.prepare(bitext, t, workers=opts.workers)
 
-# estimator model: EM iterations
-for iteration in range(opts.iterations):
-  count_fe = defaultdict(lambda: defaultdict(float))
-  count_e = defaultdict(float)
-  
-  for (f, e) in bitext:
-    e_with_null = ['NULL'] + e
-    f_len = len(f)
-    e_len = len(e)
-    
-    for i, f_word in enumerate(f):
-      total = 0.0
-      for j, e_word in enumerate(e_with_null):
-        if j == 0:
-          total += t[f_word][e_word]
-        else:
-          # Diagonal bias
-          norm_i = i / max(f_len - 1, 1)
-          norm_j = (j-1) / max(e_len - 1, 1)
-          distance = abs(norm_i - norm_j)
-          bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-          total += t[f_word][e_word] * bias
-      
-      if total > 0:
-        for j, e_word in enumerate(e_with_null):
-          if j == 0:
-            expected_count = t[f_word][e_word] / total
-          else:
-            # Diagonal bias
-            norm_i = i / max(f_len - 1, 1)
-            norm_j = (j-1) / max(e_len - 1, 1)
-            distance = abs(norm_i - norm_j)
-            bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-            expected_count = (t[f_word][e_word] * bias) / total
-          
-          count_fe[f_word][e_word] += expected_count
-          count_e[e_word] += expected_count
-  
-  # Update translation probabilities
-  new_t = defaultdict(lambda: defaultdict(float))
-  for f_word in count_fe:
-    for e_word in count_fe[f_word]:
-      if count_e[e_word] > 0:
-        new_t[f_word][e_word] = count_fe[f_word][e_word] / count_e[e_word]
-  t = new_t
+  # estimator model: EM iterations
+  em.train(t, chunks, opts.iterations, diagonal_bias, opts.workers)
+
+if opts.save_model:
+  ttable.save_model(opts.save_model, t, f_vocab, e_vocab, diagonal_bias.settings() if diagonal_bias else None, "float32" if opts.float32 else "float64", opts.top_k)
 
 sys.stderr.write("\n")
 
-for (f, e) in bitext:
-  f_len = len(f)
-  e_len = len(e)
-  for (i, f_word) in enumerate(f):
-    best_alignment = 0
-    best_score = t[f_word]['NULL']
-    for (j, e_word) in enumerate(e):
-      # Diagonal bias
-      norm_i = i / max(f_len - 1, 1)
-      norm_j = j / max(e_len - 1, 1)
-      distance = abs(norm_i - norm_j)
-      bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-      score = t[f_word][e_word] * bias
-      if score > best_score:
-        best_score = score
-        best_alignment = j
-    if best_score > 0.01:
-      sys.stdout.write("%i-%i " % (i, best_alignment))
+for links in em.viterbi(t, chunks, diagonal_bias, threshold=0.01):
+  for (i, j) in links:
+    sys.stdout.write("%i-%i " % (i, j))
   sys.stdout.write("\n")
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# Batched EM training and Viterbi decoding for the IBM Model 1 family of
+# aligners, on top of the sparse translation table in ttable.py.
+#
+# The corpus is cut into chunks of consecutive sentence pairs, and inside a
+# chunk the pairs are grouped by shape (f_len, e_len), so every group is an
+# exact (n, f_len, e_len + 1) integer matrix of t-table slots with no padding.
+# The E-step gathers t-values for a whole group at once, applies an optional
+# positional bias, normalizes each row and scatter-adds the posteriors into
+# the expected counts. The scatter-add runs in corpus order, so the counts are
+# summed in exactly the same order as the original per-word Python loops.
+#
+# With workers > 1, the chunks are split into contiguous shards and the E-step
+# runs in a pool of forked processes. The chunks are inherited through fork,
+# and t.prob plus the per-shard counts live in anonymous shared memory, so
+# nothing but the shard number is pickled per iteration. Partial counts are
+# merged in shard order, which changes the summation order but keeps runs
+# deterministic and within float rounding of the serial path.
+#
+# online() is stepwise EM for corpora too large for the chunks of prepare():
+# mini-batches are built one at a time from the (memory-mapped) corpus and the
+# table is updated after each of them, so memory is bounded by the size of the
+# t-table rather than by the size of the corpus.
+#
+# A bias is a function bias(f_len, e_len) returning an (f_len, e_len) array
+# that multiplies t(f_i|e_j), or a tuple of arrays (and scalars) that multiply
+# it one after the other; NULL (column 0 of every row) is never biased.
+# Example API usage:
+#
+# chunks = em.prepare(bitext, t, workers=workers)
+# em.train(t, chunks, iterations, bias, workers=workers)
+# for links in em.viterbi(t, chunks, bias, threshold):
+#   ... links is the list of (i, j) alignment points of one sentence pair ...
+#
+# em.online(t, bitext, passes, bias, size=1000, alpha=0.7)
+# for links in em.viterbi(t, em.batches(bitext, t), bias, threshold): ...
+import mmap
+import multiprocessing
+import sys
+import numpy as np
+
+class Chunk:
+  """ A run of consecutive sentence pairs. slots holds the t-table slot of
+  every cell of every pair in corpus order (row-major over the French words,
+  NULL first in each row), and offsets[k] is where pair k starts in it.
+  groups lists (f_len, e_len, pairs) for each shape occurring in the chunk.
+  missing tells whether some cells have no slot (slot -1), which only happens
+  when decoding text the table was not trained on """
+  def __init__(self, bitext, t):
+    self.size = len(bitext)
+    self.offsets = np.concatenate(([0], np.cumsum(bitext.f_lens() * (bitext.e_lens() + 1))))
+    self.slots = np.zeros(self.offsets[-1], dtype=np.int64)
+    self.groups = []
+    for (f_len, e_len, pairs, f, e) in bitext.shapes():
+      if f_len == 0:
+        continue
+      self.slots[self.cells(pairs, f_len, e_len)] = t.lookup(f[:, :, None], e[:, None, :]).reshape(len(pairs), -1)
+      self.groups.append((f_len, e_len, pairs))
+    self.missing = bool((self.slots < 0).any())
+
+  def cells(self, pairs, f_len, e_len):
+    """ Positions in slots of the cells of the given pairs, one row per pair """
+    return self.offsets[pairs][:, None] + np.arange(f_len * (e_len + 1))
+
+def prepare(bitext, t, size=20000, workers=1):
+  """ Cut a corpus.Corpus into chunks of at most size sentence pairs, and
+  into at least one chunk per worker """
+  size = max(min(size, -(-len(bitext) // workers)), 1)
+  return [Chunk(bitext[start:start + size], t) for start in range(0, len(bitext), size)]
+
+def reserve(bias, chunks):
+  """ Let a cached bias (bias.BiasTable) hold the matrix of every shape in
+  chunks, so cycling through them in every iteration never misses """
+  if hasattr(bias, "reserve") and isinstance(chunks, list):
+    bias.reserve(len(set((f_len, e_len) for chunk in chunks for (f_len, e_len, _) in chunk.groups)))
+
+def batches(bitext, t, size=20000):
+  """ Like prepare(), but only build each chunk when it is asked for, so
+  that no more than one chunk is held in memory at a time """
+  for start in range(0, len(bitext), size):
+    yield Chunk(bitext[start:start + size], t)
+
+def scores(t, slots, bias, missing=False):
+  """ t(f_i|e_j) * bias for an (n, f_len, e_len + 1) block of slots, where
+  with missing, slot -1 stands for t(f_i|e_j) = 0 """
+  vals = t.prob[slots]
+  if missing:
+    vals[slots < 0] = 0.0
+  if bias is not None and slots.shape[2] > 1:
+    factors = bias(slots.shape[1], slots.shape[2] - 1)
+    for factor in factors if isinstance(factors, tuple) else (factors,):
+      vals[:, :, 1:] *= factor
+  return vals
+
+def posteriors(t, chunk, bias=None):
+  """ Posterior probability of every cell of a chunk, aligned with chunk.slots """
+  posterior = np.zeros(len(chunk.slots))
+  for (f_len, e_len, pairs) in chunk.groups:
+    cells = chunk.cells(pairs, f_len, e_len)
+    vals = scores(t, chunk.slots[cells].reshape(len(pairs), f_len, e_len + 1), bias, chunk.missing)
+    # cumsum adds left to right, exactly like the scalar loop did
+    total = np.cumsum(vals, axis=2)[:, :, -1:]
+    np.divide(vals, total, out=vals, where=total > 0)
+    vals[np.broadcast_to(total <= 0, vals.shape)] = 0.0
+    posterior[cells] = vals.reshape(len(pairs), -1)
+  return posterior
+
+def estep(t, chunks, bias=None):
+  """ Expected counts (count_fe by slot, count_e by English id) under t """
+  count_fe = np.zeros(len(t))
+  count_e = np.zeros(t.e_size)
+  for chunk in chunks:
+    posterior = posteriors(t, chunk, bias)
+    np.add.at(count_fe, chunk.slots, posterior)
+    np.add.at(count_e, t.e_ids[chunk.slots], posterior)
+  return count_fe, count_e
+
+def shared_array(shape):
+  """ A zeroed float64 array in anonymous shared memory, which processes
+  forked after its creation see and write in place """
+  size = int(np.prod(shape))
+  return np.frombuffer(mmap.mmap(-1, max(size, 1) * 8), dtype=np.float64, count=size).reshape(shape)
+
+# What forked workers inherit: (t, shards, bias, prob, count_fe, count_e)
+_shared = None
+
+def _estep_shard(k):
+  (t, shards, bias, prob, count_fe, count_e) = _shared
+  t.prob = prob
+  (count_fe[k], count_e[k]) = estep(t, shards[k], bias)
+
+class Workers:
+  """ A process pool computing expected counts for contiguous shards of the
+  chunks, see estep() """
+  def __init__(self, t, chunks, bias, n):
+    global _shared
+    self.t = t
+    self.shards = [[chunks[c] for c in shard] for shard in np.array_split(np.arange(len(chunks)), n) if len(shard)]
+    self.prob = shared_array(len(t))
+    self.count_fe = shared_array((len(self.shards), len(t)))
+    self.count_e = shared_array((len(self.shards), t.e_size))
+    _shared = (t, self.shards, bias, self.prob, self.count_fe, self.count_e)
+    self.pool = multiprocessing.get_context("fork").Pool(len(self.shards))
+
+  def estep(self):
+    self.prob[:] = self.t.prob
+    self.pool.map(_estep_shard, range(len(self.shards)))
+    return self.count_fe.sum(axis=0), self.count_e.sum(axis=0)
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
+
+def train(t, chunks, iterations, bias=None, workers=1):
+  """ Run EM in place on t, with the E-step spread over workers processes """
+  reserve(bias, chunks)
+  pool = Workers(t, chunks, bias, workers) if workers > 1 and len(chunks) > 1 else None
+  try:
+    for iteration in range(iterations):
+      sys.stderr.write(".")
+      t.maximize(*(pool.estep() if pool else estep(t, chunks, bias)))
+  finally:
+    if pool:
+      pool.close()
+
+def online(t, bitext, passes, bias=None, size=1000, alpha=0.7):
+  """ Stepwise EM (Liang and Klein, 2009) in place on t: after the expected
+  counts of each mini-batch of size sentence pairs, the running counts move
+  towards them by the step size (k + 2)^-alpha, with k the number of earlier
+  mini-batches, and t(f|e) is re-estimated from the running counts.
+
+  Mini-batches are built as they are read from bitext, and the running counts
+  are kept as stored * scale so that decaying them costs nothing; only the
+  slots of the current mini-batch are touched. The counts start at t(f|e)
+  for every pair and their sum over f for every English word, so count(e)
+  is the sum of count(f, e) from the first mini-batch on; they give back
+  the initial table normalized over f """
+  count_fe = np.array(t.prob, dtype=np.float64)
+  count_e = np.bincount(t.e_ids, count_fe, minlength=t.e_size)
+  (scale, step) = (1.0, 0)
+  for p in range(passes):
+    sys.stderr.write(".")
+    for chunk in batches(bitext, t, size):
+      if not len(chunk.slots):
+        continue
+      (slots, inverse) = np.unique(chunk.slots, return_inverse=True)
+      denom = count_e[t.e_ids[slots]]
+      t.prob[slots] = np.divide(count_fe[slots], denom, out=np.zeros(len(slots)), where=denom > 0)
+      batch_fe = np.bincount(inverse.ravel(), posteriors(t, chunk, bias), minlength=len(slots))
+      (e_ids, e_inverse) = np.unique(t.e_ids[slots], return_inverse=True)
+      batch_e = np.bincount(e_inverse.ravel(), batch_fe, minlength=len(e_ids))
+      eta = (step + 2) ** -alpha
+      step += 1
+      scale *= 1 - eta
+      count_fe[slots] += eta / scale * batch_fe
+      count_e[e_ids] += eta / scale * batch_e
+      if scale < 1e-200:
+        (count_fe, count_e, scale) = (count_fe * scale, count_e * scale, 1.0)
+  t.maximize(count_fe, count_e)
+
+def best(t, chunks, bias=None):
+  """ Yield (align, score) for every sentence pair: for each French word the
+  best English position and its biased t-score, or 0 and the NULL score when
+  no English word beats NULL. Ties go to the leftmost position """
+  reserve(bias, chunks)
+  for chunk in chunks:
+    decoded = [(np.zeros(0, dtype=np.int64), np.zeros(0))] * chunk.size
+    for (f_len, e_len, pairs) in chunk.groups:
+      cells = chunk.cells(pairs, f_len, e_len)
+      vals = scores(t, chunk.slots[cells].reshape(len(pairs), f_len, e_len + 1), bias, chunk.missing)
+      score = vals[:, :, 0]
+      align = np.zeros(score.shape, dtype=np.int64)
+      if e_len > 0:
+        j = vals[:, :, 1:].argmax(axis=2)
+        top = np.take_along_axis(vals[:, :, 1:], j[:, :, None], axis=2)[:, :, 0]
+        better = top > score
+        score = np.where(better, top, score)
+        align = np.where(better, j, 0)
+      for (k, a, b) in zip(pairs, align, score):
+        decoded[k] = (a, b)
+    for sentence in decoded:
+      yield sentence
+
+def links(align, score, threshold):
+  """ The (i, j) alignment points of one decoded sentence pair whose score
+  exceeds threshold """
+  return [(i, int(align[i])) for i in np.flatnonzero(score > threshold)]
+
+def viterbi(t, chunks, bias=None, threshold=0.01):
+  """ Yield the list of (i, j) alignment points of every sentence pair, see
+  best(); words whose best score does not exceed threshold stay unaligned """
+  for (align, score) in best(t, chunks, bias):
+    yield links(align, score, threshold)
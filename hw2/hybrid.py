@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 import optparse
 import sys
-import math
-from collections import defaultdict
+import bias
+import corpus
+import em
+import ttable
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
@@ -12,138 +14,53 @@ optparser.add_option("-n", "--num_sentences", dest="num_sents", default=10000000
 optparser.add_option("-i", "--iterations", dest="iterations", default=8, type="int", help="Number of EM iterations (default=8)")
 optparser.add_option("-s", "--sigma", dest="sigma", default=1.0, type="float", help="Diagonal bias parameter (default=1.0)")
 optparser.add_option("-t", "--threshold", dest="threshold", default=0.01, type="float", help="Alignment threshold (default=0.01)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of processes for the E-step (default=1)")
+optparser.add_option("-c", "--cache", dest="cache", default=None, help="Compiled corpus cache file, '' to disable (default=<data>.<f>-<e>.bitext)")
+optparser.add_option("--online", dest="online", default=False, action="store_true", help="Train with stepwise online EM on mini-batches read one at a time (-i passes)")
+optparser.add_option("--batch-size", dest="batch_size", default=1000, type="int", help="Sentence pairs per online EM mini-batch (default=1000)")
+optparser.add_option("--alpha", dest="alpha", default=0.7, type="float", help="Online EM step size (k+2)^-alpha after k mini-batches, 0.5 < alpha <= 1 (default=0.7)")
+optparser.add_option("--save-model", dest="save_model", default=None, help="Save the trained model to this file")
+optparser.add_option("--load-model", dest="load_model", default=None, help="Align with a saved model instead of training one")
+optparser.add_option("--float32", dest="float32", default=False, action="store_true", help="Save model probabilities as float32")
+optparser.add_option("--top-k", dest="top_k", default=None, type="int", help="Save only the k most probable English words of each French word")
 (opts, _) = optparser.parse_args()
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
+cache = "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english) if opts.cache is None else opts.cache
 
-sys.stderr.write("Training hybrid alignment model...")
-bitext = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))][:opts.num_sents]
+if opts.load_model:
+  sys.stderr.write("Loading hybrid alignment model...")
+  (f_vocab, e_vocab, t, settings) = ttable.load_model(opts.load_model)
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache, f_vocab, e_vocab)
+  hybrid_bias = bias.BiasTable(**settings) if settings else None
+  chunks = em.prepare(bitext, t)
+else:
+  sys.stderr.write("Training hybrid alignment model...")
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache)
 
-# initialize vocabulary and translation probabilities
-f_vocab = set()
-e_vocab = set()
-for (f, e) in bitext:
-  f_vocab.update(f)
-  e_vocab.update(e)
+  # Product of the diagonal, position and length biases, cached per sentence shape
+  hybrid_bias = bias.BiasTable(opts.sigma, diag=True, pos=True, length=True)
 
-t = defaultdict(lambda: defaultdict(float))
-for f in f_vocab:
-  for e in e_vocab:
-    t[f][e] = 1.0 / len(e_vocab)
+  # initialize translation probabilities (implicitly uniform)
+  t = ttable.TTable(bitext, len(e_vocab))
+  if opts.online:
+    # stepwise EM over mini-batches, which are also decoded one at a time
+    em.online(t, bitext, opts.iterations, hybrid_bias, opts.batch_size, opts.alpha)
+    chunks = em.batches(bitext, t)
+  else:
+    chunks = em.prepare(bitext, t, workers=opts.workers)
 
-# estimator: EM iterations
-for iteration in range(opts.iterations):
-  count_fe = defaultdict(lambda: defaultdict(float))
-  count_e = defaultdict(float)
-  
-  for (f, e) in bitext:
-    e_with_null = ['NULL'] + e
-    f_len = len(f)
-    e_len = len(e)
-    
-    for i, f_word in enumerate(f):
-      total = 0.0
-      for j, e_word in enumerate(e_with_null):
-        if j == 0:
-          total += t[f_word][e_word]
-        else:
-          # Diagonal bias
-          norm_i = i / max(f_len - 1, 1)
-          norm_j = (j-1) / max(e_len - 1, 1)
-          distance = abs(norm_i - norm_j)
-          diag_bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-          
-          # Position bias
-          f_density = i / max(f_len - 1, 1)
-          e_density = (j-1) / max(e_len - 1, 1)
-          density_diff = abs(f_density - e_density)
-          pos_bias = math.exp(-density_diff * 2)
-          
-          # Length bias
-          len_ratio = f_len / max(e_len, 1)
-          if 0.5 <= len_ratio <= 2.0:
-            len_bias = 1.0
-          else:
-            len_bias = 0.5
-          
-          combined_bias = diag_bias * pos_bias * len_bias
-          total += t[f_word][e_word] * combined_bias
-      
-      if total > 0:
-        for j, e_word in enumerate(e_with_null):
-          if j == 0:
-            expected_count = t[f_word][e_word] / total
-          else:
-            # Diagonal bias
-            norm_i = i / max(f_len - 1, 1)
-            norm_j = (j-1) / max(e_len - 1, 1)
-            distance = abs(norm_i - norm_j)
-            diag_bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-            
-            # Position bias
-            f_density = i / max(f_len - 1, 1)
-            e_density = (j-1) / max(e_len - 1, 1)
-            density_diff = abs(f_density - e_density)
-            pos_bias = math.exp(-density_diff * 2)
-            
-            # Length bias
-            len_ratio = f_len / max(e_len, 1)
-            if 0.5 <= len_ratio <= 2.0:
-              len_bias = 1.0
-            else:
-              len_bias = 0.5
-            
-            combined_bias = diag_bias * pos_bias * len_bias
-            expected_count = (t[f_word][e_word] * combined_bias) / total
-          
-          count_fe[f_word][e_word] += expected_count
-          count_e[e_word] += expected_count
-  
-  # Update translation probabilities
-  new_t = defaultdict(lambda: defaultdict(float))
-  for f_word in count_fe:
-    for e_word in count_fe[f_word]:
-      if count_e[e_word] > 0:
-        new_t[f_word][e_word] = count_fe[f_word][e_word] / count_e[e_word]
-  t = new_t
+    # estimator: EM iterations
+    em.train(t, chunks, opts.iterations, hybrid_bias, opts.workers)
+
+if opts.save_model:
+  ttable.save_model(opts.save_model, t, f_vocab, e_vocab, hybrid_bias.settings() if hybrid_bias else None, "float32" if opts.float32 else "float64", opts.top_k)
 
 sys.stderr.write("\n")
 
-for (f, e) in bitext:
-  f_len = len(f)
-  e_len = len(e)
-  for (i, f_word) in enumerate(f):
-    best_alignment = 0
-    best_score = t[f_word]['NULL']
-    for (j, e_word) in enumerate(e):
-      # Translation probability
-      trans_prob = t[f_word][e_word]
-      
-      # Diagonal bias
-      norm_i = i / max(f_len - 1, 1)
-      norm_j = j / max(e_len - 1, 1)
-      distance = abs(norm_i - norm_j)
-      diag_bias = math.exp(-(distance ** 2) / (2 * opts.sigma ** 2))
-      
-      # Position bias
-      f_density = i / max(f_len - 1, 1)
-      e_density = j / max(e_len - 1, 1)
-      density_diff = abs(f_density - e_density)
-      pos_bias = math.exp(-density_diff * 2)
-      
-      # Length bias
-      len_ratio = f_len / max(e_len, 1)
-      if 0.5 <= len_ratio <= 2.0:
-        len_bias = 1.0
-      else:
-        len_bias = 0.5
-      
-      # Combined score
-      score = trans_prob * diag_bias * pos_bias * len_bias
-      
-      if score > best_score:
-        best_score = score
-        best_alignment = j
-    if best_score > opts.threshold:
-      sys.stdout.write("%i-%i " % (i, best_alignment))
+# The decoder multiplies t by each bias term in turn, as the E-step does not
+decode_bias = bias.BiasTable(factors=True, **hybrid_bias.settings()) if hybrid_bias else None
+for links in em.viterbi(t, chunks, decode_bias, threshold=opts.threshold):
+  for (i, j) in links:
+    sys.stdout.write("%i-%i " % (i, j))
   sys.stdout.write("\n")
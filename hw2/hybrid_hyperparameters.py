@@ -1,9 +1,17 @@
 #!/usr/bin/env python
+import csv
+from itertools import islice
+import json
+import multiprocessing
 import optparse
+import os
 import sys
-import math
-from collections import defaultdict
-import subprocess
+import time
+import aer
+import bias
+import corpus
+import em
+import ttable
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
@@ -11,110 +19,92 @@ optparser.add_option("-e", "--english", dest="english", default="e", help="Suffi
 optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix of French filename (default=f)")
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=1000, type="int", help="Number of sentences to use for training and alignment")
 optparser.add_option("-i", "--iterations", dest="iterations", default=8, type="int", help="Number of EM iterations (default=8)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of processes for the E-step (default=1)")
+optparser.add_option("-a", "--alignments", dest="alignment", default="a", help="Suffix of gold alignments filename (default=a)")
+optparser.add_option("-j", "--jobs", dest="jobs", default=None, type="int", help="Number of sigma values trained in parallel, each with a single E-step process (default=number of cores, or 1 with -w)")
+optparser.add_option("-o", "--output", dest="output", default="hybrid_hyperparameters_output.txt", help="Score report (default=hybrid_hyperparameters_output.txt)")
+optparser.add_option("-r", "--results", dest="results", default="hybrid_hyperparameters_results.csv", help="Results table, .csv or .json (default=hybrid_hyperparameters_results.csv)")
+optparser.add_option("-c", "--cache", dest="cache", default=None, help="Compiled corpus cache file, '' to disable (default=<data>.<f>-<e>.bitext)")
 (opts, _) = optparser.parse_args()
 
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
+a_data = "%s.%s" % (opts.train, opts.alignment)
+cache = "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english) if opts.cache is None else opts.cache
 
 # Load bitext
 sys.stderr.write("Loading parallel corpus...\n")
-bitext = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))][:opts.num_sents]
+(f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache)
 
 # Define ranges for sigma and threshold
 sigma_values = [0.4, 0.3, 0.2, 0.1]
 threshold_values = [round(x * 0.001, 3) for x in range(1, 11)]
 
-def run_alignment(sigma, threshold):
-    # Initialize vocabulary and translation probabilities
-    f_vocab = set()
-    e_vocab = set()
-    for (f, e) in bitext:
-        f_vocab.update(f)
-        e_vocab.update(e)
-    t = defaultdict(lambda: defaultdict(float))
-    for f_word in f_vocab:
-        for e_word in e_vocab:
-            t[f_word][e_word] = 1.0 / len(e_vocab)
+gold = aer.Gold(a_data)
+# E-step workers cannot be nested inside the sweep's own process pool
+if opts.jobs is None:
+    opts.jobs = 1 if opts.workers > 1 else os.cpu_count()
+jobs = max(min(opts.jobs, len(sigma_values)), 1)
+if jobs > 1 and opts.workers > 1:
+    sys.stderr.write(f"[WARN] -w {opts.workers} ignored: the E-step runs in 1 process per job with -j {jobs}.\n")
+
+def sweep_sigma(sigma):
+    """ Train once for sigma, then decode and score every threshold from the
+    same t-table. The threshold only filters the Viterbi links, so the argmax
+    pass is shared as well, and all thresholds are scored in one call """
+    start = time.time()
+    # Initialize translation probabilities (implicitly uniform)
+    t = ttable.TTable(bitext, len(e_vocab))
+    workers = opts.workers if jobs == 1 else 1
+    chunks = em.prepare(bitext, t, workers=workers)
+    # t is multiplied by each bias term in turn, in training and decoding
+    table = bias.BiasTable(sigma, diag=True, pos=True, length=True, factors=True)
 
     # EM iterations
-    for iteration in range(opts.iterations):
-        count_fe = defaultdict(lambda: defaultdict(float))
-        count_e = defaultdict(float)
-        for (f, e) in bitext:
-            e_with_null = ['NULL'] + e
-            f_len = len(f)
-            e_len = len(e)
-            for i, f_word in enumerate(f):
-                total = 0.0
-                for j, e_word in enumerate(e_with_null):
-                    if j == 0:
-                        total += t[f_word][e_word]
-                    else:
-                        norm_i = i / max(f_len - 1, 1)
-                        norm_j = (j - 1) / max(e_len - 1, 1)
-                        diag_bias = math.exp(-((norm_i - norm_j) ** 2) / (2 * sigma ** 2))
-                        pos_bias = math.exp(-abs(norm_i - norm_j) * 2)
-                        len_bias = 1.0 if 0.5 <= f_len / max(e_len, 1) <= 2.0 else 0.5
-                        total += t[f_word][e_word] * diag_bias * pos_bias * len_bias
-                if total > 0:
-                    for j, e_word in enumerate(e_with_null):
-                        if j == 0:
-                            expected_count = t[f_word][e_word] / total
-                        else:
-                            norm_i = i / max(f_len - 1, 1)
-                            norm_j = (j - 1) / max(e_len - 1, 1)
-                            diag_bias = math.exp(-((norm_i - norm_j) ** 2) / (2 * sigma ** 2))
-                            pos_bias = math.exp(-abs(norm_i - norm_j) * 2)
-                            len_bias = 1.0 if 0.5 <= f_len / max(e_len, 1) <= 2.0 else 0.5
-                            expected_count = (t[f_word][e_word] * diag_bias * pos_bias * len_bias) / total
-                        count_fe[f_word][e_word] += expected_count
-                        count_e[e_word] += expected_count
-        # Update translation probabilities
-        new_t = defaultdict(lambda: defaultdict(float))
-        for f_word in count_fe:
-            for e_word in count_fe[f_word]:
-                if count_e[e_word] > 0:
-                    new_t[f_word][e_word] = count_fe[f_word][e_word] / count_e[e_word]
-        t = new_t
+    em.train(t, chunks, opts.iterations, table, workers)
+    train_seconds = time.time() - start
+
+    # Only the sentences covered by the gold alignments are scored
+    decoded = list(islice(em.best(t, chunks, table), len(gold)))
+    candidates = []
+    decode_seconds = []
+    for threshold in threshold_values:
+        start = time.time()
+        candidates.append([em.links(align, score, threshold) for (align, score) in decoded])
+        decode_seconds.append(time.time() - start)
+    start = time.time()
+    scores = gold.score_many(candidates)
+    score_seconds = (time.time() - start) / len(threshold_values)
+
+    rows = []
+    for (threshold, (precision, recall, error), seconds) in zip(threshold_values, scores, decode_seconds):
+        rows.append({"sigma": sigma, "threshold": threshold,
+                     "precision": float(precision), "recall": float(recall), "aer": float(error),
+                     "train_seconds": round(train_seconds, 3),
+                     "decode_seconds": round(seconds, 4),
+                     "score_seconds": round(score_seconds, 4)})
+    sys.stderr.write(f"Finished sigma={sigma} in {train_seconds:.1f}s\n")
+    return rows
+
+def write_results(filename, rows):
+    with open(filename, "w", newline="") as out_file:
+        if filename.endswith(".json"):
+            json.dump(rows, out_file, indent=1)
+        else:
+            writer = csv.DictWriter(out_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
 
-    # Generate alignment as string
-    alignment_lines = []
-    for (f, e) in bitext:
-        f_len = len(f)
-        e_len = len(e)
-        line = []
-        for i, f_word in enumerate(f):
-            best_alignment = 0
-            best_score = t[f_word]['NULL']
-            for j, e_word in enumerate(e):
-                trans_prob = t[f_word][e_word]
-                norm_i = i / max(f_len - 1, 1)
-                norm_j = j / max(e_len - 1, 1)
-                diag_bias = math.exp(-((norm_i - norm_j) ** 2) / (2 * sigma ** 2))
-                pos_bias = math.exp(-abs(norm_i - norm_j) * 2)
-                len_bias = 1.0 if 0.5 <= f_len / max(e_len, 1) <= 2.0 else 0.5
-                score = trans_prob * diag_bias * pos_bias * len_bias
-                if score > best_score:
-                    best_score = score
-                    best_alignment = j
-            if best_score > threshold:
-                line.append(f"{i}-{best_alignment}")
-        alignment_lines.append(" ".join(line))
-    return "\n".join(alignment_lines)
+# Each sigma trains in its own process; the corpus is inherited on fork
+sys.stderr.write(f"Sweeping sigma={sigma_values} with {jobs} job(s)\n")
+if jobs > 1:
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        rows = sum(pool.map(sweep_sigma, sigma_values), [])
+else:
+    rows = sum(map(sweep_sigma, sigma_values), [])
 
-# Main loop: run alignment, pipe to score-alignments, capture last 3 lines
-with open("hybrid_hyperparameters_output.txt", "w") as out_file:
-    for sigma in sigma_values:
-        for threshold in threshold_values:
-            sys.stderr.write(f"Processing sigma={sigma}, threshold={threshold}\n")
-            alignment_str = run_alignment(sigma, threshold)
-            # Run score-alignments via subprocess
-            score_proc = subprocess.Popen(
-                ["python", "score-alignments"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE
-            )
-            output, _ = score_proc.communicate(input=alignment_str.encode("utf-8"))
-            output_lines = output.decode("utf-8").splitlines()[-3:]  # last 3 lines
-            out_file.write(f"# sigma={sigma}, threshold={threshold}\n")
-            out_file.write("\n".join(output_lines) + "\n\n")
+with open(opts.output, "w") as out_file:
+    for row in rows:
+        out_file.write(f"# sigma={row['sigma']}, threshold={row['threshold']}\n")
+        out_file.write("Precision = %f\nRecall = %f\nAER = %f\n\n" % (row["precision"], row["recall"], row["aer"]))
+write_results(opts.results, rows)
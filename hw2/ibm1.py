@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 import optparse
 import sys
-from collections import defaultdict
+import bias
+import corpus
+import em
+import ttable
 
 optparser = optparse.OptionParser()
 optparser.add_option("-d", "--data", dest="train", default="data/hansards", help="Data filename prefix (default=data)")
@@ -9,61 +12,49 @@ optparser.add_option("-e", "--english", dest="english", default="e", help="Suffi
 optparser.add_option("-f", "--french", dest="french", default="f", help="Suffix of French filename (default=f)")
 optparser.add_option("-n", "--num_sentences", dest="num_sents", default=100000000000, type="int", help="Number of sentences to use for training and alignment")
 optparser.add_option("-i", "--iterations", dest="iterations", default=5, type="int", help="Number of EM iterations (default=5)")
+optparser.add_option("-w", "--workers", dest="workers", default=1, type="int", help="Number of processes for the E-step (default=1)")
+optparser.add_option("-c", "--cache", dest="cache", default=None, help="Compiled corpus cache file, '' to disable (default=<data>.<f>-<e>.bitext)")
+optparser.add_option("--online", dest="online", default=False, action="store_true", help="Train with stepwise online EM on mini-batches read one at a time (-i passes)")
+optparser.add_option("--batch-size", dest="batch_size", default=1000, type="int", help="Sentence pairs per online EM mini-batch (default=1000)")
+optparser.add_option("--alpha", dest="alpha", default=0.7, type="float", help="Online EM step size (k+2)^-alpha after k mini-batches, 0.5 < alpha <= 1 (default=0.7)")
+optparser.add_option("--save-model", dest="save_model", default=None, help="Save the trained model to this file")
+optparser.add_option("--load-model", dest="load_model", default=None, help="Align with a saved model instead of training one")
+optparser.add_option("--float32", dest="float32", default=False, action="store_true", help="Save model probabilities as float32")
+optparser.add_option("--top-k", dest="top_k", default=None, type="int", help="Save only the k most probable English words of each French word")
 (opts, _) = optparser.parse_args()
 f_data = "%s.%s" % (opts.train, opts.french)
 e_data = "%s.%s" % (opts.train, opts.english)
+cache = "%s.%s-%s.bitext" % (opts.train, opts.french, opts.english) if opts.cache is None else opts.cache
 
-sys.stderr.write("Training IBM Model 1...")
-bitext = [[sentence.strip().split() for sentence in pair] for pair in zip(open(f_data), open(e_data))][:opts.num_sents]
+if opts.load_model:
+  sys.stderr.write("Loading IBM Model 1...")
+  (f_vocab, e_vocab, t, settings) = ttable.load_model(opts.load_model)
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache, f_vocab, e_vocab)
+  model_bias = bias.BiasTable(**settings) if settings else None
+  chunks = em.prepare(bitext, t)
+else:
+  sys.stderr.write("Training IBM Model 1...")
+  (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, opts.num_sents, cache)
+  model_bias = None
 
-# Initialize vocabulary and translation probabilities
-f_vocab = set()
-e_vocab = set()
-for (f, e) in bitext:
-  f_vocab.update(f)
-  e_vocab.update(e)
+  # Initialize translation probabilities (implicitly uniform)
+  t = ttable.TTable(bitext, len(e_vocab))
+  if opts.online:
+    # stepwise EM over mini-batches, which are also decoded one at a time
+    em.online(t, bitext, opts.iterations, model_bias, opts.batch_size, opts.alpha)
+    chunks = em.batches(bitext, t)
+  else:
+    chunks = em.prepare(bitext, t, workers=opts.workers)
 
-t = defaultdict(lambda: defaultdict(float))
-for f in f_vocab:
-  for e in e_vocab:
-    t[f][e] = 1.0 / len(e_vocab)
+    # EM iterations
+    em.train(t, chunks, opts.iterations, model_bias, opts.workers)
 
-# EM iterations
-for iteration in range(opts.iterations):
-  sys.stderr.write("../../../../Desktop/MT backup/jhu-mt-hw/hw2")
-  count_fe = defaultdict(lambda: defaultdict(float))
-  count_e = defaultdict(float)
-  
-  for (f, e) in bitext:
-    e_with_null = ['NULL'] + e
-    
-    for f_word in f:
-      total = sum(t[f_word][e_word] for e_word in e_with_null)
-      
-      if total > 0:
-        for e_word in e_with_null:
-          expected_count = t[f_word][e_word] / total
-          count_fe[f_word][e_word] += expected_count
-          count_e[e_word] += expected_count
-  
-  # Update translation probabilities
-  new_t = defaultdict(lambda: defaultdict(float))
-  for f_word in count_fe:
-    for e_word in count_fe[f_word]:
-      if count_e[e_word] > 0:
-        new_t[f_word][e_word] = count_fe[f_word][e_word] / count_e[e_word]
-  t = new_t
+if opts.save_model:
+  ttable.save_model(opts.save_model, t, f_vocab, e_vocab, model_bias.settings() if model_bias else None, "float32" if opts.float32 else "float64", opts.top_k)
 
 sys.stderr.write("\n")
 
-for (f, e) in bitext:
-  for (i, f_word) in enumerate(f):
-    best_alignment = 0
-    best_prob = t[f_word]['NULL']
-    for (j, e_word) in enumerate(e):
-      if t[f_word][e_word] > best_prob:
-        best_prob = t[f_word][e_word]
-        best_alignment = j
-    if best_prob > 0.01:
-      sys.stdout.write("%i-%i " % (i, best_alignment))
+for links in em.viterbi(t, chunks, model_bias, threshold=0.01):
+  for (i, j) in links:
+    sys.stdout.write("%i-%i " % (i, j))
   sys.stdout.write("\n")
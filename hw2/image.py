@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Binary images of named NumPy arrays, shared by the corpus cache (corpus.py)
+# and saved alignment models (ttable.py).
+#
+# Layout: a magic string, the length of a JSON header as a little-endian
+# uint64, the header, then each array at a 64-byte aligned offset. Arrays are
+# memory-mapped read-only when loaded, so opening an image costs next to
+# nothing and only the pages that are actually touched are read from disk.
+# Example API usage:
+#
+# image.save("model.bin", b"hw2model", {"version": 1}, {"prob": prob})
+# (header, arrays) = image.load("model.bin", b"hw2model")
+import json
+import os
+import numpy as np
+
+ALIGN = 64
+
+def _start(magic, size):
+  return -(-(len(magic) + 8 + size) // ALIGN) * ALIGN
+
+def save(path, magic, header, arrays):
+  """ Write a dict of 1-d arrays and a JSON-serializable header, atomically """
+  (layout, offset) = ({}, 0)
+  for (name, a) in arrays.items():
+    layout[name] = (offset, a.dtype.str, len(a))
+    offset += -(-a.nbytes // ALIGN) * ALIGN
+  header = json.dumps(dict(header, arrays=layout)).encode("utf-8")
+  start = _start(magic, len(header))
+  tmp = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp, "wb") as out:
+    out.write(magic + len(header).to_bytes(8, "little") + header)
+    for (name, a) in arrays.items():
+      out.seek(start + layout[name][0])
+      out.write(np.ascontiguousarray(a).tobytes())
+    out.truncate(start + offset)
+  os.replace(tmp, path)
+
+def load(path, magic):
+  """ Memory-map an image written by save(). Returns (header, arrays), or
+  None if the file is missing or not an image with this magic string """
+  try:
+    with open(path, "rb") as f:
+      if f.read(len(magic)) != magic:
+        return None
+      size = int.from_bytes(f.read(8), "little")
+      header = json.loads(f.read(size).decode("utf-8"))
+  except (OSError, ValueError):
+    return None
+  start = _start(magic, size)
+  arrays = {}
+  for (name, (offset, dtype, length)) in header.pop("arrays").items():
+    arrays[name] = (np.memmap(path, dtype=dtype, mode="r", offset=start + offset, shape=(length,))
+                    if length else np.zeros(0, dtype=dtype))
+  return header, arrays
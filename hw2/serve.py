@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Long-running alignment server on a saved model (see --save-model in
+# ibm1.py, diagonal.py and hybrid.py).
+#
+# Every request is one line "french sentence ||| english sentence" and its
+# reply is the alignment line the aligners would print for that pair. The
+# model is loaded once. Requests are queued and decoded in micro-batches of up
+# to -b pairs, waiting at most --wait milliseconds for a batch to fill, with
+# the vectorized Viterbi argmax of em.py. Requests are read from stdin
+# (replies go to stdout, in order) or, with -p, from any number of
+# connections to a local TCP port. Latency and throughput go to stderr:
+#
+# python hybrid.py -s 0.3 --save-model hybrid.model > alignment
+# echo "le chat ||| the cat" | python serve.py -m hybrid.model
+# python serve.py -m hybrid.model -p 5000 -r 60 &
+import collections
+import optparse
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+import numpy as np
+import bias
+import corpus
+import em
+import ttable
+
+optparser = optparse.OptionParser()
+optparser.add_option("-m", "--model", dest="model", default="hybrid.model", help="Saved alignment model (default=hybrid.model)")
+optparser.add_option("-t", "--threshold", dest="threshold", default=0.01, type="float", help="Alignment threshold (default=0.01)")
+optparser.add_option("-b", "--batch-size", dest="batch_size", default=256, type="int", help="Maximum number of pairs decoded together (default=256)")
+optparser.add_option("--wait", dest="wait", default=2.0, type="float", help="Milliseconds to wait for a batch to fill (default=2)")
+optparser.add_option("-p", "--port", dest="port", default=None, type="int", help="Serve on this local TCP port instead of stdin/stdout")
+optparser.add_option("-r", "--report", dest="report", default=0, type="float", help="Report latency and throughput every this many seconds (default=only at exit)")
+
+class Aligner:
+  """ A saved model, decoding lists of (french, english) token lists """
+  def __init__(self, model, threshold):
+    (self.f_vocab, self.e_vocab, self.t, settings) = ttable.load_model(model)
+    # t is multiplied by each bias term in turn, as the aligners decode
+    self.bias = bias.BiasTable(factors=True, **settings) if settings else None
+    self.threshold = threshold
+
+  def align(self, pairs):
+    (_, _, bitext) = corpus.build(pairs, self.f_vocab, self.e_vocab, frozen=True)
+    chunks = em.prepare(bitext, self.t, size=max(len(bitext), 1))
+    return [em.links(align, score, self.threshold) for (align, score) in em.best(self.t, chunks, self.bias)]
+
+class Request:
+  def __init__(self, pair):
+    self.pair = pair
+    self.links = None
+    self.start = time.time()
+    self.done = threading.Event()
+
+class Stats:
+  """ Latency of recent requests and totals since the server started """
+  def __init__(self, window=100000):
+    self.lock = threading.Lock()
+    self.latency = collections.deque(maxlen=window)
+    self.started = time.time()
+    self.pairs = 0
+    self.batches = 0
+    self.busy = 0.0
+
+  def add(self, batch, seconds):
+    now = time.time()
+    with self.lock:
+      self.latency.extend(now - request.start for request in batch)
+      self.pairs += len(batch)
+      self.batches += 1
+      self.busy += seconds
+
+  def report(self):
+    with self.lock:
+      if not self.pairs:
+        sys.stderr.write("No requests served\n")
+        return
+      (p50, p90, p99) = np.percentile(np.array(self.latency) * 1000, [50, 90, 99])
+      sys.stderr.write("%d pairs in %d batches (%.1f per batch), %.0f pairs/s decoding, %.0f pairs/s overall, "
+                       "latency ms p50 %.2f p90 %.2f p99 %.2f\n"
+                       % (self.pairs, self.batches, self.pairs / self.batches, self.pairs / max(self.busy, 1e-9),
+                          self.pairs / (time.time() - self.started), p50, p90, p99))
+
+class Batcher(threading.Thread):
+  """ Decodes queued requests in micro-batches """
+  def __init__(self, aligner, size, wait, stats, report=0):
+    super().__init__(daemon=True)
+    self.aligner = aligner
+    self.size = max(size, 1)
+    self.wait = wait
+    self.stats = stats
+    self.report = report
+    self.requests = queue.Queue()
+
+  def submit(self, pair):
+    request = Request(pair)
+    self.requests.put(request)
+    return request
+
+  def run(self):
+    last_report = time.time()
+    while True:
+      batch = [self.requests.get()]
+      deadline = time.time() + self.wait
+      while len(batch) < self.size:
+        try:
+          batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+        except queue.Empty:
+          break
+      start = time.time()
+      try:
+        decoded = self.aligner.align([request.pair for request in batch])
+      except Exception as e:
+        sys.stderr.write("ERROR: could not align a batch: %s\n" % e)
+        decoded = [[]] * len(batch)
+      for (request, links) in zip(batch, decoded):
+        request.links = links
+        request.done.set()
+      self.stats.add(batch, time.time() - start)
+      if self.report and time.time() - last_report >= self.report:
+        self.stats.report()
+        last_report = time.time()
+
+def parse(line):
+  (f, _, e) = line.partition("|||")
+  return (f.split(), e.split())
+
+def pipe(lines, write, flush, batcher):
+  """ Submit every request line, and write the replies in order; replies
+  are flushed whenever no more requests are waiting for theirs """
+  pending = queue.Queue()
+  def read():
+    for line in lines:
+      pending.put(batcher.submit(parse(line)))
+    pending.put(None)
+  threading.Thread(target=read, daemon=True).start()
+  while True:
+    request = pending.get()
+    if request is None:
+      break
+    request.done.wait()
+    write("".join("%i-%i " % (i, j) for (i, j) in request.links) + "\n")
+    if pending.empty():
+      flush()
+  flush()
+
+class Handler(socketserver.StreamRequestHandler):
+  def handle(self):
+    pipe((line.decode("utf-8") for line in self.rfile),
+         lambda s: self.wfile.write(s.encode("utf-8")), self.wfile.flush, self.server.batcher)
+
+class Server(socketserver.ThreadingTCPServer):
+  allow_reuse_address = True
+  daemon_threads = True
+
+if __name__ == "__main__":
+  (opts, _) = optparser.parse_args()
+  # Report on kill as well as on ^C or at the end of stdin
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  start = time.time()
+  aligner = Aligner(opts.model, opts.threshold)
+  sys.stderr.write("Loaded %s (%d t-table entries) in %.2fs\n" % (opts.model, len(aligner.t), time.time() - start))
+  stats = Stats()
+  batcher = Batcher(aligner, opts.batch_size, opts.wait / 1000, stats, opts.report)
+  batcher.start()
+  try:
+    if opts.port is not None:
+      with Server(("127.0.0.1", opts.port), Handler) as server:
+        server.batcher = batcher
+        sys.stderr.write("Serving on 127.0.0.1:%d\n" % opts.port)
+        server.serve_forever()
+    else:
+      pipe(sys.stdin, sys.stdout.write, sys.stdout.flush, batcher)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    stats.report()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Sparse translation table shared by the IBM Model 1 family of aligners
+# (ibm1.py, diagonal.py, hybrid.py, ablation.py, hybrid_hyperparameters.py).
+#
+# Words are interned to integer ids, and t(f|e) is only stored for the (f, e)
+# pairs that actually co-occur in some sentence pair, so memory grows with the
+# number of co-occurrences rather than with |F| x |E|. Example API usage:
+#
+# (f_vocab, e_vocab, bitext) = corpus.read(f_data, e_data, num_sents)
+# t = ttable.TTable(bitext, len(e_vocab))
+# s = t.lookup(f_ids, e_ids)  # slots of (f, e) pairs, broadcasting like numpy
+# ... t.prob[s] is t(f|e) ...
+# t.maximize(count_fe, count_e)  # M-step from expected counts
+#
+# A trained table can be saved together with the vocabularies and the bias
+# settings it was trained with as a model image (see image.py), optionally
+# with float32 probabilities and only the top k English words per French
+# word. Loading memory-maps it, so decoding new text needs no EM at all:
+#
+# ttable.save_model("hybrid.model", t, f_vocab, e_vocab, table.settings(), np.float32, top_k=10)
+# (f_vocab, e_vocab, t, settings) = ttable.load_model("hybrid.model")
+import numpy as np
+import corpus
+import image
+from corpus import NULL_ID
+
+def pair_keys(bitext, e_size, chunk=20000):
+  """ Sorted unique keys f * e_size + e of every co-occurring (f, e) pair of
+  a corpus.Corpus, including (f, NULL) for every French word """
+  keys = [np.zeros(0, dtype=np.int64)]
+  for start in range(0, len(bitext), chunk):
+    part = [(f.astype(np.int64)[:, :, None] * e_size + e[:, None, :]).ravel()
+            for (_, _, _, f, e) in bitext[start:start + chunk].shapes()]
+    keys.append(np.unique(np.concatenate(part)))
+  return np.unique(np.concatenate(keys))
+
+class TTable:
+  """ t(f|e) over co-occurring pairs in CSR layout: the English ids seen with
+  French id f are e_ids[indptr[f]:indptr[f+1]] (sorted), and prob holds t(f|e)
+  in the same slots. Every f co-occurs with NULL.
+
+  Initialization is implicitly uniform, t(f|e) = 1/|E| with |E| the English
+  vocabulary without NULL. NULL is not part of that vocabulary so it starts
+  with t(f|NULL) = 0, as in the original dense dict-of-dicts scripts. """
+  def __init__(self, bitext, e_size):
+    self.index(pair_keys(bitext, e_size), e_size)
+    self.prob = np.where(self.e_ids == NULL_ID, 0.0, 1.0 / max(e_size - 1, 1))
+
+  @classmethod
+  def from_keys(cls, keys, prob, e_size):
+    """ A table over the given sorted pair keys with the given t(f|e) """
+    t = cls.__new__(cls)
+    t.index(keys, e_size)
+    t.prob = prob
+    return t
+
+  def index(self, keys, e_size):
+    self.e_size = e_size
+    self.keys = keys
+    (f_ids, e_ids) = np.divmod(keys, e_size)
+    n_f = int(f_ids[-1]) + 1 if len(f_ids) else 0
+    self.indptr = np.searchsorted(f_ids, np.arange(n_f + 1))
+    self.e_ids = e_ids
+
+  def __len__(self):
+    return len(self.keys)
+
+  def lookup(self, f_ids, e_ids):
+    """ Slots of the (f, e) pairs in e_ids/prob, or -1 where they never co-occur
+    (or are not in the table at all, like words unseen in training) """
+    e_ids = np.asarray(e_ids, dtype=np.int64)
+    keys = np.where(e_ids < self.e_size, np.asarray(f_ids, dtype=np.int64) * self.e_size + e_ids, -1)
+    if not len(self.keys):
+      return np.full(keys.shape, -1)
+    s = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+    return np.where(self.keys[s] == keys, s, -1)
+
+  def get(self, f_id, e_id):
+    s = self.lookup(f_id, e_id)
+    return float(self.prob[s]) if s >= 0 else 0.0
+
+  def save(self, filename):
+    """ Checkpoint the parameters; restore() reads them back into a table
+    built from the same corpus """
+    with open(filename, "wb") as out:
+      np.savez(out, e_size=self.e_size, keys=self.keys, prob=self.prob)
+
+  def restore(self, filename):
+    checkpoint = np.load(filename)
+    if int(checkpoint["e_size"]) != self.e_size or not np.array_equal(checkpoint["keys"], self.keys):
+      raise ValueError("%s was trained on a different corpus" % filename)
+    self.prob = checkpoint["prob"]
+
+  def maximize(self, count_fe, count_e):
+    """ M-step: t(f|e) = count(f, e) / count(e), where count_fe is indexed by
+    slot and count_e by English id """
+    denom = count_e[self.e_ids]
+    self.prob = np.divide(count_fe, denom, out=np.zeros(len(self)), where=denom > 0)
+
+  def top(self, k):
+    """ A copy keeping only the k most probable English words of each French
+    word; ties keep the lower English ids """
+    f_ids = np.repeat(np.arange(len(self.indptr) - 1), np.diff(self.indptr))
+    order = np.lexsort((-self.prob, f_ids))
+    rank = np.arange(len(order)) - self.indptr[f_ids[order]]
+    keep = np.zeros(len(order), dtype=bool)
+    keep[order] = rank < k
+    return TTable.from_keys(self.keys[keep], self.prob[keep], self.e_size)
+
+# Model image (see image.py). Bump MODEL_VERSION whenever its arrays change
+MODEL_MAGIC = b"hw2model"
+MODEL_VERSION = 1
+
+def save_model(path, t, f_vocab, e_vocab, settings=None, dtype=np.float64, top_k=None):
+  """ Write t with the vocabularies it is indexed by and the bias settings
+  (a dict of bias.BiasTable arguments, or None) it was trained with """
+  if top_k is not None:
+    t = t.top(top_k)
+  image.save(path, MODEL_MAGIC, {"version": MODEL_VERSION, "e_size": t.e_size, "bias": settings},
+             {"keys": t.keys, "prob": t.prob.astype(dtype, copy=False),
+              "f_words": corpus.pack_words(f_vocab), "e_words": corpus.pack_words(e_vocab)})
+
+def load_model(path):
+  """ Memory-map a model written by save_model(). Returns (f_vocab, e_vocab,
+  t, settings) """
+  loaded = image.load(path, MODEL_MAGIC)
+  if loaded is None:
+    raise ValueError("%s is not an alignment model" % path)
+  (header, arrays) = loaded
+  if header.get("version") != MODEL_VERSION:
+    raise ValueError("%s is an alignment model of another version" % path)
+  t = TTable.from_keys(arrays["keys"], arrays["prob"], header["e_size"])
+  return corpus.unpack_words(arrays["f_words"]), corpus.unpack_words(arrays["e_words"]), t, header["bias"]
@@ -1,8 +1,85 @@
 #!/usr/bin/env python
 # Simple translation model and language model data structures
+from array import array
+from bisect import bisect_left
+from functools import lru_cache
+import json
+import mmap
+import os
 import sys
 from collections import namedtuple
 
+# Compiled models (see CompiledTM and LM) are binary images: a magic string,
+# the length of a JSON header as a little-endian uint64, the header, and then
+# arrays at 8-byte aligned offsets, listed in the header with their typecodes.
+# Images are memory-mapped, so opening one only reads its header, and all the
+# processes using the same image on a host share its pages.
+def source_key(filename, version):
+  """ Identifies the current contents of a text model """
+  st = os.stat(filename)
+  return "%d:%d:%d" % (version, st.st_size, st.st_mtime_ns)
+
+def write_image(path, magic, header, arrays):
+  """ Write a dict of arrays and a JSON-serializable header, atomically """
+  layout = {}
+  # a fixed-width placeholder header first, to find where the arrays start
+  offset = len(magic) + 8 + len(json.dumps(dict(header, arrays=dict((name, (10**15, 10**15, "q")) for name in arrays))))
+  for (name, a) in arrays.items():
+    offset = -(-offset // 8) * 8
+    layout[name] = (offset, len(a), a.typecode)
+    offset += len(a) * a.itemsize
+  text = json.dumps(dict(header, arrays=layout)).encode("utf-8")
+  tmp = "%s.tmp%d" % (path, os.getpid())
+  with open(tmp, "wb") as out:
+    out.write(magic + len(text).to_bytes(8, "little") + text)
+    for (name, a) in arrays.items():
+      out.seek(layout[name][0])
+      out.write(a.tobytes())
+  os.replace(tmp, path)
+
+def read_image(path, magic, key=None):
+  """ Memory-map an image written by write_image(). Returns (header, arrays),
+  or None if path is missing, not an image with this magic string, or (with
+  key) compiled from another version of its source """
+  try:
+    with open(path, "rb") as f:
+      if f.read(len(magic)) != magic:
+        return None
+      size = int.from_bytes(f.read(8), "little")
+      header = json.loads(f.read(size).decode("utf-8"))
+      if key is not None and header.get("key") != key:
+        return None
+      view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+  except (OSError, ValueError):
+    return None
+  arrays = {}
+  for (name, (offset, length, typecode)) in header.pop("arrays").items():
+    arrays[name] = view[offset:offset + length * array(typecode).itemsize].cast(typecode)
+  return header, arrays
+
+def string(offsets, pool, i):
+  """ String i of a pool of UTF-8 strings delimited by offsets """
+  return bytes(pool[offsets[i]:offsets[i+1]]).decode("utf-8")
+
+def search_strings(offsets, pool, s):
+  """ The index of s in a sorted pool of strings, or None """
+  (lo, hi) = (0, len(offsets) - 1)
+  while lo < hi:
+    mid = (lo + hi) // 2
+    if string(offsets, pool, mid) < s:
+      lo = mid + 1
+    else:
+      hi = mid
+  return lo if lo < len(offsets) - 1 and string(offsets, pool, lo) == s else None
+
+def pool_strings(strings):
+  """ The (offsets, pool) arrays of a list of strings """
+  (offsets, pool) = (array("Q", [0]), array("B"))
+  for s in strings:
+    pool.frombytes(s.encode("utf-8"))
+    offsets.append(len(pool))
+  return offsets, pool
+
 # A translation model is a dictionary where keys are tuples of French words
 # and values are lists of (english, logprob) named tuples. For instance,
 # the French phrase "que se est" has two translations, represented like so:
@@ -10,18 +87,133 @@ from collections import namedtuple
 #   phrase(english='what has', logprob=-0.301030009985), 
 #   phrase(english='what has been', logprob=-0.301030009985)]
 # k is a pruning parameter: only the top k translations are kept for each f.
+# With sentences (a list of tuples of French words), only the phrases that
+# occur in some sentence are loaded.
+#
+# The text phrase table is compiled once into <filename>.bin (see CompiledTM),
+# which later runs memory-map, so startup does not grow with the table.
 phrase = namedtuple("phrase", "english, logprob")
-def TM(filename, k):
+def TM(filename, k, sentences=None):
   sys.stderr.write("Reading translation model from %s...\n" % (filename,))
+  compiled = CompiledTM.open(filename)
+  if compiled is None:
+    return read_tm(filename, k, sentences)
+  return compiled.table(k, sentences)
+
+def read_tm(filename, k, sentences=None):
+  """ Parse the text phrase table """
   tm = {}
   for line in open(filename).readlines():
     (f, e, logprob) = line.strip().split(" ||| ")
     tm.setdefault(tuple(f.split()), []).append(phrase(e, float(logprob)))
+  if sentences is not None:
+    spans = set(f[i:j] for f in sentences for i in range(len(f)) for j in range(i+1, len(f)+1))
+    tm = dict((f, tm[f]) for f in spans if f in tm)
   for f in tm: # prune all but top k translations
     tm[f].sort(key=lambda x: -x.logprob)
     del tm[f][k:] 
   return tm
 
+class CompiledTM:
+  """ A phrase table compiled into an image with these arrays:
+
+  - f_words/f_pool: the sorted French vocabulary; the id of a word is its rank
+  - f_ids/phrases: the source phrases as runs of French word ids, sorted, so
+    phrase p is f_ids[phrases[p]:phrases[p+1]]
+  - first/english/logprob: the translations of phrase p are the entries
+    first[p]:first[p+1], best first (ties in file order), each an English
+    phrase id and a log probability
+  - e_words/e_pool: the distinct English phrases
+
+  Lookups binary-search the mapped arrays, so only the pages they touch are
+  read from disk """
+  MAGIC = b"hw3tm"
+  VERSION = 2
+
+  def __init__(self, header, arrays):
+    for (name, a) in arrays.items():
+      setattr(self, name, a)
+    self.max_len = header["max_len"]
+
+  @classmethod
+  def open(cls, filename):
+    """ The compiled form of a text phrase table, compiling it first if it
+    is missing or older than the table; None if it cannot be written """
+    (path, key) = (filename + ".bin", source_key(filename, cls.VERSION))
+    compiled = read_image(path, cls.MAGIC, key)
+    if compiled is None:
+      try:
+        write_image(path, cls.MAGIC, *compile_tm(filename, key))
+      except OSError as e:
+        sys.stderr.write("WARNING: could not write compiled translation model %s: %s\n" % (path, e))
+        return None
+      compiled = read_image(path, cls.MAGIC, key)
+    return cls(*compiled)
+
+  def source(self, p):
+    return tuple(self.f_ids[self.phrases[p]:self.phrases[p+1]])
+
+  def search(self, ids):
+    """ The first source phrase not sorting before the id tuple ids """
+    (lo, hi) = (0, len(self.phrases) - 1)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.source(mid) < ids:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def translations(self, p, k):
+    return [phrase(string(self.e_words, self.e_pool, self.english[n]), self.logprob[n])
+            for n in range(self.first[p], min(self.first[p+1], self.first[p] + k))]
+
+  def table(self, k, sentences=None):
+    """ The TM dictionary, for the phrases occurring in sentences if given """
+    n = len(self.phrases) - 1
+    if sentences is None:
+      return dict((tuple(string(self.f_words, self.f_pool, w) for w in self.source(p)), self.translations(p, k))
+                  for p in range(n))
+    tm = {}
+    for f in sentences:
+      ids = [search_strings(self.f_words, self.f_pool, word) for word in f]
+      for i in range(len(f)):
+        # extend f[i:j] while it is still a prefix of some source phrase
+        for j in range(i+1, min(len(f), i + self.max_len) + 1):
+          if ids[j-1] is None:
+            break
+          key = tuple(ids[i:j])
+          p = self.search(key)
+          if p == n or self.source(p)[:len(key)] != key:
+            break
+          if f[i:j] not in tm and self.source(p) == key:
+            tm[f[i:j]] = self.translations(p, k)
+    return tm
+
+def compile_tm(filename, key):
+  """ The (header, arrays) of the CompiledTM of a text phrase table """
+  entries = {}
+  for line in open(filename):
+    (f, e, logprob) = line.strip().split(" ||| ")
+    entries.setdefault(tuple(f.split()), []).append((e, float(logprob)))
+  words = sorted(set(word for f in entries for word in f))
+  f_id = dict((word, i) for (i, word) in enumerate(words))
+  (f_ids, phrases, first, english, logprob) = (array("I"), array("Q", [0]), array("Q", [0]), array("I"), array("d"))
+  e_id = {}
+  # word ids are ranks, so sorting phrases by words sorts them by ids too
+  for f in sorted(entries):
+    f_ids.extend(f_id[word] for word in f)
+    phrases.append(len(f_ids))
+    for (e, p) in sorted(entries[f], key=lambda x: -x[1]):
+      english.append(e_id.setdefault(e, len(e_id)))
+      logprob.append(p)
+    first.append(len(english))
+  (f_words, f_pool) = pool_strings(words)
+  (e_words, e_pool) = pool_strings(e_id)
+  header = {"version": CompiledTM.VERSION, "key": key, "max_len": max([len(f) for f in entries] + [0])}
+  return header, {"f_words": f_words, "f_pool": f_pool, "f_ids": f_ids, "phrases": phrases,
+                  "first": first, "english": english, "logprob": logprob, "e_words": e_words, "e_pool": e_pool}
+
 # # A language model scores sequences of English words, and must account
 # # for both beginning and end of each sequence. Example API usage:
 # lm = models.LM(filename)
@@ -32,30 +224,148 @@ def TM(filename, k):
 #   (lm_state, word_logprob) = lm.score(lm_state, word)
 #   logprob += word_logprob
 # logprob += lm.end(lm_state) # transition to </s>, can also use lm.score(lm_state, "</s>")[1]
-ngram_stats = namedtuple("ngram_stats", "logprob, backoff")
+#
+# States are small ints; lm.words(lm_state) is the context they stand for.
+# Words are interned to ids (their rank in the sorted vocabulary) and the
+# n-grams are kept in a sorted-array trie: level n holds the n-grams sorted by
+# key = (index of their prefix in level n-1) * (|V| + 1) + word id + 1, with
+# float32 log probabilities and backoffs. score() is memoized on
+# (state, word) in a bounded LRU cache.
+#
+# filename is either an ARPA file, which is compiled once into the image
+# <filename>.bin (see compile-lm) that later runs memory-map, or an image.
 class LM:
-  def __init__(self, filename):
+  MAGIC = b"hw3lm"
+  VERSION = 1
+
+  def __init__(self, filename, cache_size=1 << 18):
     sys.stderr.write("Reading language model from %s...\n" % (filename,))
-    self.table = {}
-    for line in open(filename):
-      entry = line.strip().split("\t")
-      if len(entry) > 1 and entry[0] != "ngram":
-        (logprob, ngram, backoff) = (float(entry[0]), tuple(entry[1].split()), float(entry[2] if len(entry)==3 else 0.0))
-        self.table[ngram] = ngram_stats(logprob, backoff)
+    compiled = read_image(filename, self.MAGIC)
+    if compiled is None:
+      (path, key) = (filename + ".bin", source_key(filename, self.VERSION))
+      compiled = read_image(path, self.MAGIC, key)
+    if compiled is None:
+      compiled = compile_lm(filename, key)
+      try:
+        write_image(path, self.MAGIC, *compiled)
+      except OSError as e:
+        sys.stderr.write("WARNING: could not write compiled language model %s: %s\n" % (path, e))
+    (header, arrays) = compiled
+    if header.get("version") != self.VERSION:
+      raise ValueError("%s is a language model image of another version" % filename)
+    (self.word_offsets, self.pool) = (arrays["words"], arrays["pool"])
+    self.base = len(self.word_offsets)
+    self.keys = [array("q")] + [arrays["keys%d" % n] for n in range(1, header["order"] + 1)]
+    self.logprob = [array("f")] + [arrays["logprob%d" % n] for n in range(1, header["order"] + 1)]
+    self.backoff = [array("f")] + [arrays["backoff%d" % n] for n in range(1, header["order"] + 1)]
+    self.word_id = lru_cache(maxsize=cache_size)(self.find_word)
+    self.score = lru_cache(maxsize=cache_size)(self.uncached_score)
+    self.states = []
+    self.state_ids = {}
+    self.suffixes = []
+    start = self.word_id("<s>")
+    self.start = self.state((start,) if start is not None else ())
+    unk = self.word_id("<unk>")
+    self.unk = self.logprob[1][unk] if unk is not None and self.logprob[1][unk] == self.logprob[1][unk] else None
+
+  def find_word(self, word):
+    """ The id of a word, or None """
+    return search_strings(self.word_offsets, self.pool, word)
+
+  def find(self, ngram):
+    """ Index of a tuple of word ids in its level of the trie, or -1 """
+    i = 0
+    for (n, word) in enumerate(ngram, 1):
+      if n >= len(self.keys):
+        return -1
+      key = i * self.base + word + 1
+      i = bisect_left(self.keys[n], key)
+      if i == len(self.keys[n]) or self.keys[n][i] != key:
+        return -1
+    return i
+
+  def state(self, context):
+    """ The int state of a tuple of word ids. A new state also records, for
+    each suffix of its context from the longest down to the empty one, the
+    suffix length n, its trie index (-1 if it has no children to look up),
+    its backoff and its last word """
+    s = self.state_ids.get(context)
+    if s is None:
+      s = self.state_ids[context] = len(self.states)
+      self.states.append(context)
+      suffixes = []
+      for n in range(len(context), -1, -1):
+        i = self.find(context[len(context)-n:])
+        backoff = self.backoff[n][i] if n > 0 and i >= 0 else 0.0
+        suffixes.append((n, i if n + 1 < len(self.keys) else -1, backoff, context[len(context)-n:][-1:]))
+      self.suffixes.append(suffixes)
+    return s
+
+  def words(self, state):
+    """ The context of a state as a tuple of words """
+    return tuple(string(self.word_offsets, self.pool, i) for i in self.states[state])
 
   def begin(self):
-    return ("<s>",)
+    return self.start
 
-  def score(self, state, word):
-    ngram = state + (word,)
+  def uncached_score(self, state, word):
+    w = self.word_id(word)
     score = 0.0
-    while len(ngram)> 0:
-      if ngram in self.table:
-        return (ngram[-2:], score + self.table[ngram].logprob)
-      else: #backoff
-        score += self.table[ngram[:-1]].backoff if len(ngram) > 1 else 0.0 
-        ngram = ngram[1:]
-    return ((), score + self.table[("<unk>",)].logprob)
-    
+    if w is not None:
+      for (n, i, backoff, last) in self.suffixes[state]:
+        # the n-gram of the suffix plus word is the child w + 1 of trie node i
+        if i < 0:
+          score += backoff
+          continue
+        if n:
+          (keys, key) = (self.keys[n+1], i * self.base + w + 1)
+          j = bisect_left(keys, key)
+          if j == len(keys) or keys[j] != key:
+            score += backoff
+            continue
+        else:
+          j = w
+        logprob = self.logprob[n+1][j]
+        if logprob == logprob:
+          return (self.state(last + (w,)), score + logprob)
+        score += backoff #backoff
+    else:
+      score = sum(backoff for (_, _, backoff, _) in self.suffixes[state])
+    if self.unk is None:
+      raise KeyError(("<unk>",))
+    return (self.state(()), score + self.unk)
+
   def end(self, state):
     return self.score(state, "</s>")[1]
+
+def compile_lm(filename, key=None):
+  """ The (header, arrays) of the LM image of an ARPA file """
+  entries = {}
+  for line in open(filename):
+    entry = line.strip().split("\t")
+    if len(entry) > 1 and entry[0] != "ngram":
+      entries[tuple(entry[1].split())] = (float(entry[0]), float(entry[2] if len(entry)==3 else 0.0))
+  words = sorted(set(word for ngram in entries for word in ngram))
+  vocab = dict((word, i) for (i, word) in enumerate(words))
+  order = max([len(ngram) for ngram in entries] + [1])
+  by_order = [{} for _ in range(order + 1)]
+  for (ngram, stats) in entries.items():
+    by_order[len(ngram)][tuple(vocab[word] for word in ngram)] = stats
+  # n-grams whose prefix is missing are reached through a placeholder
+  # prefix without a probability of its own (NaN) and without backoff. Every
+  # word gets a unigram, so the unigram of word id w has index w
+  for n in range(order, 1, -1):
+    for ngram in by_order[n]:
+      by_order[n-1].setdefault(ngram[:-1], (float("nan"), 0.0))
+  for w in range(len(words)):
+    by_order[1].setdefault((w,), (float("nan"), 0.0))
+  (offsets, pool) = pool_strings(words)
+  arrays = {"words": offsets, "pool": pool}
+  index = {(): 0}
+  for n in range(1, order + 1):
+    level = sorted((index[ngram[:-1]] * len(offsets) + ngram[-1] + 1, ngram) for ngram in by_order[n])
+    arrays["keys%d" % n] = array("q", [k for (k, _) in level])
+    arrays["logprob%d" % n] = array("f", [by_order[n][ngram][0] for (_, ngram) in level])
+    arrays["backoff%d" % n] = array("f", [by_order[n][ngram][1] for (_, ngram) in level])
+    index = dict((ngram, i) for (i, (_, ngram)) in enumerate(level))
+  return {"version": LM.VERSION, "key": key, "order": order}, arrays
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# The model score of translations: the LM logprob of the English plus the
+# TM logprob summed over every way of segmenting the French and English
+# into aligned phrase pairs, as computed by compute-model-score.
+#
+# The phrase pairs of a French sentence are looked up in the TM once, with
+# the coverage bitmap of their French span, and matched against each
+# candidate through an index of the candidate's n-grams by position, so
+# any number of candidates can be scored against the same source:
+#
+# scorer = Scorer(tm, lm)
+# for (lm_logprob, tm_logprob) in scorer.score(french, candidates): ...
+import math
+from collections import defaultdict
+from functools import reduce
+
+def bitmap(sequence):
+  """ Generate a coverage bitmap for a sequence of indexes """
+  return reduce(lambda x,y: x|y, map(lambda i: int('1'+'0'*i,2), sequence), 0)
+
+def bitmap2str(b, n, on='o', off='.'):
+  """ Generate a length-n string representation of bitmap b """
+  return '' if n==0 else (on if b&1==1 else off) + bitmap2str(b>>1, n-1, on, off)
+
+def logadd10(x,y):
+  """ Addition in logspace (base 10): if x=log(a) and y=log(b), returns log(a+b) """
+  return x + math.log10(1 + pow(10,y-x))
+
+class Scorer:
+  """ Scores English candidates for French sentences. tm must have a
+  translation for every French word, as decode and compute-model-score
+  ensure for unknown words """
+  def __init__(self, tm, lm):
+    self.tm = tm
+    self.lm = lm
+
+  def lm_logprob(self, e):
+    lm_state = self.lm.begin()
+    lm_logprob = 0.0
+    for word in e + ("</s>",):
+      (lm_state, word_logprob) = self.lm.score(lm_state, word)
+      lm_logprob += word_logprob
+    return lm_logprob
+
+  def phrases(self, f):
+    """ The (English words, logprob, span bitmap) of every phrase pair of f,
+    by French span, and the length of the longest English phrase """
+    pairs = []
+    for fi in range(len(f)):
+      for fj in range(fi+1,len(f)+1):
+        bits = ((1 << (fj-fi)) - 1) << fi
+        for phrase in self.tm.get(f[fi:fj], ()):
+          pairs.append((tuple(phrase.english.split()), phrase.logprob, bits))
+    return pairs, max([len(ephrase) for (ephrase, _, _) in pairs] + [0])
+
+  def tm_logprob(self, f, e, phrases=None):
+    """ The sum over all phrase alignments of f and e of their TM logprob,
+    or None if there are none """
+    (pairs, longest) = phrases or self.phrases(f)
+    # Where each English n-gram occurs
+    positions = defaultdict(list)
+    for ei in range(len(e)):
+      for ej in range(ei+1, min(ei+longest, len(e))+1):
+        positions[e[ei:ej]].append(ei)
+    alignments = [[] for _ in e]
+    for (ephrase, logprob, bits) in pairs:
+      for ei in positions.get(ephrase, ()):
+        alignments[ei].append((ei+len(ephrase), logprob, bits))
+
+    # Forward sum over (English prefix, French coverage), in the same order
+    # of additions as compute-model-score -v 2, so the sums are identical
+    chart = [{} for _ in e] + [{}]
+    chart[0][0] = 0.0
+    for ei, sums in enumerate(chart[:-1]):
+      for v in sums:
+        for (ej, logprob, bits) in alignments[ei]:
+          if bits & v == 0:
+            new_v = bits | v
+            if new_v in chart[ej]:
+              chart[ej][new_v] = logadd10(chart[ej][new_v], sums[v]+logprob)
+            else:
+              chart[ej][new_v] = sums[v]+logprob
+    return chart[len(e)].get((1 << len(f)) - 1)
+
+  def score(self, f, candidates):
+    """ The (LM logprob, TM logprob or None) of each English candidate, a
+    tuple of words, for f """
+    phrases = self.phrases(f)
+    return [(self.lm_logprob(e), self.tm_logprob(f, e, phrases)) for e in candidates]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks the LSTM of seq2seq.py on CPU against the textbook equations,
+with one matmul per gate for the input and another for the hidden state:
+
+    python lstm_benchmark.py --batch_size 64 --seq_len 14
+
+Every variant runs the same weights over the same batch, and their outputs
+are checked against the textbook version before timing.
+"""
+
+import argparse
+import logging
+import time
+
+import torch
+
+from seq2seq import LSTM
+
+
+logging.basicConfig(level=logging.DEBUG,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+
+def textbook(lstm, inputs, hidden):
+    """the LSTM equations gate by gate, with the weights of each gate sliced
+    out of the fused ones
+    """
+    W_i, W_f, W_o, W_c = lstm.W.weight.chunk(4, 0)
+    b_i, b_f, b_o, b_c = lstm.W.bias.chunk(4, 0)
+    U_i, U_f, U_o, U_c = lstm.U.weight.chunk(4, 0)
+    h, c = hidden
+    outputs = []
+    for t in range(inputs.size(1)):
+        x = inputs[:, t]
+        i = torch.sigmoid(x @ W_i.t() + b_i + h @ U_i.t())
+        f = torch.sigmoid(x @ W_f.t() + b_f + h @ U_f.t())
+        o = torch.sigmoid(x @ W_o.t() + b_o + h @ U_o.t())
+        c = f * c + i * torch.tanh(x @ W_c.t() + b_c + h @ U_c.t())
+        h = o * torch.tanh(c)
+        outputs.append(h)
+    return torch.stack(outputs, 1)
+
+
+def fused_steps(lstm, inputs, hidden):
+    """the fused cell one timestep at a time, as the decoder runs it
+    """
+    outputs = []
+    for t in range(inputs.size(1)):
+        hidden = lstm(inputs[:, t], hidden)
+        outputs.append(hidden[0])
+    return torch.stack(outputs, 1)
+
+
+def fused_sequence(lstm, inputs, hidden):
+    """the whole sequence, its input projected in one matmul, as the encoder runs it
+    """
+    return lstm.sequence(inputs, hidden)[0]
+
+
+def time_per_step(run, lstm, inputs, hidden, repeat, backward):
+    """milliseconds per timestep, the best of repeat runs
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if backward:
+            run(lstm, inputs, hidden).sum().backward()
+        else:
+            with torch.no_grad():
+                run(lstm, inputs, hidden)
+        best = min(best, time.perf_counter() - start)
+    return best / inputs.size(1) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--hidden_size', default=256, type=int,
+                    help='hidden size, also input size')
+    ap.add_argument('--batch_size', default=64, type=int,
+                    help='sentences per batch (1 for unbatched training and translation)')
+    ap.add_argument('--seq_len', default=14, type=int,
+                    help='timesteps per sequence')
+    ap.add_argument('--repeat', default=20, type=int,
+                    help='runs of each variant, the fastest is reported')
+    ap.add_argument('--threads', default=None, type=int,
+                    help='torch CPU threads (default: torch default)')
+    args = ap.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    lstm = LSTM(args.hidden_size, args.hidden_size)
+    scripted = LSTM(args.hidden_size, args.hidden_size, script=True)
+    scripted.load_state_dict(lstm.state_dict())
+    inputs = torch.randn(args.batch_size, args.seq_len, args.hidden_size)
+    hidden = (torch.zeros(args.batch_size, args.hidden_size),
+              torch.zeros(args.batch_size, args.hidden_size))
+
+    variants = [('textbook, per gate', textbook, lstm),
+                ('fused, per step', fused_steps, lstm),
+                ('fused, sequence', fused_sequence, lstm),
+                ('fused, sequence, TorchScript', fused_sequence, scripted)]
+
+    with torch.no_grad():
+        reference = textbook(lstm, inputs, hidden)
+        for name, run, module in variants[1:]:
+            error = (run(module, inputs, hidden) - reference).abs().max().item()
+            logging.info('%s: max abs difference from textbook %.3g', name, error)
+
+    logging.info('batch %d, %d steps, hidden %d: ms per timestep (forward / forward+backward)',
+                 args.batch_size, args.seq_len, args.hidden_size)
+    baseline = None
+    for name, run, module in variants:
+        forward = time_per_step(run, module, inputs, hidden, args.repeat, False)
+        backward = time_per_step(run, module, inputs, hidden, args.repeat, True)
+        baseline = baseline or (forward, backward)
+        logging.info('%-30s %7.3f (%.1fx) / %7.3f (%.1fx)', name,
+                     forward, baseline[0] / forward, backward, baseline[1] / backward)
+
+
+if __name__ == '__main__':
+    main()
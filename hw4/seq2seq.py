@@ -12,8 +12,14 @@ Students *MAY NOT* view the above tutorial or use it as a reference in any way.
 from __future__ import unicode_literals, print_function, division
 
 import argparse
+import hashlib
+import json
 import logging
+import os
+import pickle
+import queue
 import random
+import threading
 import time
 from io import open
 
@@ -33,6 +39,7 @@ from torch import optim
 
 logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s %(levelname)s %(message)s')
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
 
 # we are forcing the use of cpu, if you have access to a gpu, you can set the flag to "cuda"
 # make sure you are very careful if you are using a gpu on a shared cluster/grid, 
@@ -71,6 +78,25 @@ class Vocab:
         else:
             self.word2count[word] += 1
 
+    def state_dict(self):
+        """the vocab as plain lists, which torch.save can store without pickling a Vocab
+        """
+        words = [self.index2word[i] for i in range(self.n_words)]
+        return {'lang_code': self.lang_code,
+                'words': words,
+                'counts': [self.word2count.get(word, 0) for word in words]}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        vocab = cls(state['lang_code'])
+        for i, (word, count) in enumerate(zip(state['words'], state['counts'])):
+            if i >= 2:  # SOS and EOS are already there
+                vocab.word2index[word] = i
+                vocab.word2count[word] = count
+                vocab.index2word[i] = word
+        vocab.n_words = len(state['words'])
+        return vocab
+
 
 ######################################################################
 
@@ -91,13 +117,12 @@ def split_lines(input_file):
     return pairs
 
 
-def make_vocabs(src_lang_code, tgt_lang_code, train_file):
-    """ Creates the vocabs for each of the langues based on the training corpus.
+def make_vocabs(src_lang_code, tgt_lang_code, train_pairs):
+    """ Creates the vocabs for each of the langues based on the training pairs.
     """
     src_vocab = Vocab(src_lang_code)
     tgt_vocab = Vocab(tgt_lang_code)
 
-    train_pairs = split_lines(train_file)
 
     for pair in train_pairs:
         src_vocab.add_sentence(pair[0])
@@ -110,8 +135,8 @@ def make_vocabs(src_lang_code, tgt_lang_code, train_file):
 
 ######################################################################
 
-def tensor_from_sentence(vocab, sentence):
-    """creates a tensor from a raw sentence
+def indexes_from_sentence(vocab, sentence):
+    """creates a list of word indexes, ending with EOS, from a raw sentence
     """
     indexes = []
     for word in sentence.split():
@@ -121,6 +146,13 @@ def tensor_from_sentence(vocab, sentence):
             pass
             # logging.warn('skipping unknown subword %s. Joint BPE can produces subwords at test time which are not in vocab. As long as this doesnt happen every sentence, this is fine.', word)
     indexes.append(EOS_index)
+    return indexes
+
+
+def tensor_from_sentence(vocab, sentence):
+    """creates a tensor from a raw sentence
+    """
+    indexes = indexes_from_sentence(vocab, sentence)
     return torch.tensor(indexes, dtype=torch.long, device=device).view(-1, 1)
 
 
@@ -132,13 +164,189 @@ def tensors_from_pair(src_vocab, tgt_vocab, pair):
     return input_tensor, target_tensor
 
 
+class Dataset:
+    """sentence pairs as int index arrays, each sentence ending with EOS.
+    the source sentences are stored back to back in src, sentence i being
+    src[src_offsets[i]:src_offsets[i + 1]], and likewise the targets in tgt.
+    pairs are also grouped into buckets of the same source and target
+    length, in order of length
+    """
+    def __init__(self, src, src_offsets, tgt, tgt_offsets):
+        self.src = src
+        self.src_offsets = src_offsets
+        self.tgt = tgt
+        self.tgt_offsets = tgt_offsets
+        src_lengths = src_offsets[1:] - src_offsets[:-1]
+        tgt_lengths = tgt_offsets[1:] - tgt_offsets[:-1]
+        lengths = src_lengths * (int(tgt_lengths.max()) + 1 if len(tgt_lengths) else 1) + tgt_lengths
+        order = torch.argsort(lengths, stable=True)
+        counts = torch.unique_consecutive(lengths[order], return_counts=True)[1]
+        self.buckets = list(torch.split(order, counts.tolist()))
+
+    @classmethod
+    def from_pairs(cls, pairs, src_vocab, tgt_vocab):
+        arrays = []
+        for side, vocab in enumerate((src_vocab, tgt_vocab)):
+            sentences = [indexes_from_sentence(vocab, pair[side] if side < len(pair) else '')
+                         for pair in pairs]
+            offsets = [0]
+            for sentence in sentences:
+                offsets.append(offsets[-1] + len(sentence))
+            arrays.append(torch.tensor([i for sentence in sentences for i in sentence], dtype=torch.int32))
+            arrays.append(torch.tensor(offsets, dtype=torch.long))
+        return cls(*arrays)
+
+    def state_dict(self):
+        return {'src': self.src, 'src_offsets': self.src_offsets,
+                'tgt': self.tgt, 'tgt_offsets': self.tgt_offsets}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(state['src'], state['src_offsets'], state['tgt'], state['tgt_offsets'])
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
+
+    @staticmethod
+    def _pad(flat, offsets, positions):
+        lengths = offsets[positions + 1] - offsets[positions]
+        steps = torch.arange(int(lengths.max()))
+        mask = steps.unsqueeze(0) < lengths.unsqueeze(1)
+        index = (offsets[positions].unsqueeze(1) + steps.unsqueeze(0)).clamp(max=max(len(flat) - 1, 0))
+        padded = torch.where(mask, flat[index].long(), torch.full_like(index, EOS_index))
+        return padded.to(device), mask.float().to(device)
+
+    def batch(self, positions):
+        """the pairs at a tensor of positions as (batch, seq) tensors padded
+        with EOS, and float masks that are 1 for real tokens and 0 for padding:
+        returns input_tensor, input_mask, target_tensor, target_mask
+        """
+        return self.sources(positions) + self._pad(self.tgt, self.tgt_offsets, positions)
+
+    def sources(self, positions):
+        """the source sentences alone: returns input_tensor, input_mask
+        """
+        return self._pad(self.src, self.src_offsets, positions)
+
+    def make_batches(self, batch_size):
+        """splits the pairs into minibatches of positions from consecutive
+        buckets, so that little of a batch is padding. buckets are shuffled so
+        batches differ from one epoch to the next, and batches come in random order
+        """
+        order = torch.cat([bucket[torch.randperm(len(bucket))] for bucket in self.buckets])
+        batches = list(torch.split(order, batch_size))
+        random.shuffle(batches)
+        return batches
+
+
+# bump whenever the layout of the cache or of Dataset.state_dict() changes
+DATA_CACHE_VERSION = 1
+
+
+def data_files_key(args):
+    """what a dataset cache was made from: the cache format version, the
+    language codes and the size and modification time of each data file
+    """
+    files = [args.train_file, args.dev_file, args.test_file]
+    return [DATA_CACHE_VERSION, args.src_lang, args.tgt_lang] + [[f, os.path.getsize(f), os.stat(f).st_mtime_ns] for f in files]
+
+
+def load_data(args, src_vocab=None, tgt_vocab=None):
+    """returns the vocabs and the train, dev and test Datasets. they are read
+    from args.data_cache, memory-mapped, if it was made from the same files
+    (and vocabs, if given); otherwise they are made from the data files and
+    the cache is rewritten
+    """
+    key = data_files_key(args)
+    if args.data_cache and os.path.exists(args.data_cache):
+        cache = torch.load(args.data_cache, mmap=True, weights_only=True)
+        if cache.get('key') == key and (src_vocab is None or (
+                cache['src_vocab'] == src_vocab.state_dict() and cache['tgt_vocab'] == tgt_vocab.state_dict())):
+            logging.info('Loaded data from %s', args.data_cache)
+            return (Vocab.from_state_dict(cache['src_vocab']), Vocab.from_state_dict(cache['tgt_vocab']),
+                    Dataset.from_state_dict(cache['train']), Dataset.from_state_dict(cache['dev']),
+                    Dataset.from_state_dict(cache['test']))
+
+    train_pairs = split_lines(args.train_file)
+    if src_vocab is None:
+        src_vocab, tgt_vocab = make_vocabs(args.src_lang, args.tgt_lang, train_pairs)
+    datasets = [Dataset.from_pairs(pairs, src_vocab, tgt_vocab)
+                for pairs in (train_pairs, split_lines(args.dev_file), split_lines(args.test_file))]
+    if args.data_cache:
+        cache = {'key': key, 'src_vocab': src_vocab.state_dict(), 'tgt_vocab': tgt_vocab.state_dict(),
+                 'train': datasets[0].state_dict(), 'dev': datasets[1].state_dict(), 'test': datasets[2].state_dict()}
+        torch.save(cache, args.data_cache + '.tmp')
+        os.replace(args.data_cache + '.tmp', args.data_cache)
+        logging.info('Wrote data cache to %s', args.data_cache)
+    return (src_vocab, tgt_vocab) + tuple(datasets)
+
+
 ######################################################################
 
 
+def lstm_cell(gates, c):
+    """the LSTM equations, given the pre-activations of the input, forget and
+    output gates and the candidate cell state, side by side in gates
+    """
+    i, f, o, g = gates.chunk(4, 1)
+    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    h = torch.sigmoid(o) * torch.tanh(c)
+    return h, c
+
+
+def lstm_loop(projected, U, h, c, mask):
+    # type: (Tensor, Tensor, Tensor, Tensor, Optional[Tensor]) -> Tuple[Tensor, Tensor, Tensor]
+    """runs the LSTM over a sequence whose input projections (batch, seq, 4 * hidden)
+    are already computed, so each step only multiplies by the hidden weights U.
+    where mask (if given) is 0, for padding, the state is carried over.
+    returns the outputs (batch, seq, hidden) and the last h and c
+    """
+    outputs = []
+    # unbind, unlike indexing each step, gives a backward pass that is a single stack
+    for t, x in enumerate(projected.unbind(1)):
+        h_new, c_new = lstm_cell(torch.addmm(x, h, U.t()), c)
+        if mask is None:
+            h, c = h_new, c_new
+        else:
+            m = mask[:, t].unsqueeze(1)
+            h = m * h_new + (1 - m) * h
+            c = m * c_new + (1 - m) * c
+        outputs.append(h)
+    return torch.stack(outputs, 1), h, c
+
+
+class LSTM(nn.Module):
+    """an LSTM cell with a forget gate, shared by the encoder and decoder.
+    the four gates are computed together: one matmul of the input by W and
+    one of h by U give all their pre-activations. forward() runs one timestep
+    for a batch: input is (batch, input_size), hidden is a tuple (h, c) of
+    (batch, hidden_size) tensors. sequence() runs a whole (batch, seq, input_size)
+    input, projecting all of it by W in a single matmul first; with
+    script=True its loop is compiled with TorchScript
+    """
+    def __init__(self, input_size, hidden_size, script=False):
+        super(LSTM, self).__init__()
+        self.input_size = input_size
+        self.hidden_size = hidden_size
+        # input, forget and output gates, and the candidate cell state
+        self.W = nn.Linear(input_size, 4 * hidden_size)
+        self.U = nn.Linear(hidden_size, 4 * hidden_size, bias=False)
+        self.loop = torch.jit.script(lstm_loop) if script else lstm_loop
+
+    def forward(self, input, hidden):
+        h, c = hidden
+        return lstm_cell(self.W(input) + self.U(h), c)
+
+    def sequence(self, inputs, hidden, mask=None):
+        h, c = hidden
+        outputs, h, c = self.loop(self.W(inputs), self.U.weight, h, c, mask)
+        return outputs, (h, c)
+
+
 class EncoderRNN(nn.Module):
     """the class for the enoder RNN
     """
-    def __init__(self, input_size, hidden_size):
+    def __init__(self, input_size, hidden_size, script=False):
         super(EncoderRNN, self).__init__()
         self.hidden_size = hidden_size
         """Initilize a word embedding and bi-directional LSTM encoder
@@ -147,21 +355,20 @@ class EncoderRNN(nn.Module):
         See, for example, https://en.wikipedia.org/wiki/Long_short-term_memory#LSTM_with_a_forget_gate
         You should make your LSTM modular and re-use it in the Decoder.
         """
-        "*** YOUR CODE HERE ***"
-        raise NotImplementedError
-        return output, hidden
-
-
-    def forward(self, input, hidden):
-        """runs the forward pass of the encoder
-        returns the output and the hidden state
+        self.embedding = nn.Embedding(input_size, hidden_size)
+        self.lstm = LSTM(hidden_size, hidden_size, script=script)
+
+    def forward(self, input, hidden, mask=None):
+        """runs the forward pass of the encoder over a (batch, seq) tensor
+        of word indexes. returns the outputs (batch, seq, hidden) and the
+        hidden state; where mask is 0 (padding) the state is carried over,
+        so the hidden state is the one after each sentence's last word
         """
-        "*** YOUR CODE HERE ***"
-        raise NotImplementedError
-        return output, hidden
+        return self.lstm.sequence(self.embedding(input), hidden, mask)
 
-    def get_initial_hidden_state(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+    def get_initial_hidden_state(self, batch_size=1):
+        return (torch.zeros(batch_size, self.hidden_size, device=device),
+                torch.zeros(batch_size, self.hidden_size, device=device))
 
 
 class AttnDecoderRNN(nn.Module):
@@ -178,37 +385,76 @@ class AttnDecoderRNN(nn.Module):
         
         """Initilize your word embedding, decoder LSTM, and weights needed for your attention here
         """
-        "*** YOUR CODE HERE ***"
-        raise NotImplementedError
+        self.embedding = nn.Embedding(self.output_size, self.hidden_size)
+        self.lstm = LSTM(self.hidden_size, self.hidden_size)
+        self.attn = nn.Linear(self.hidden_size, self.hidden_size, bias=False)
+        self.attn_combine = nn.Linear(self.hidden_size * 2, self.hidden_size)
 
         self.out = nn.Linear(self.hidden_size, self.output_size)
 
-    def forward(self, input, hidden, encoder_outputs):
-        """runs the forward pass of the decoder
+    def forward(self, input, hidden, encoder_outputs, mask=None):
+        """runs the forward pass of the decoder for one step of a batch:
+        input is (batch,) word indexes, encoder_outputs is (batch, seq, hidden)
+        and mask (batch, seq) marks the real source words
         returns the log_softmax, hidden state, and attn_weights
         
         Dropout (self.dropout) should be applied to the word embeddings.
         """
-        
-        "*** YOUR CODE HERE ***"
-        raise NotImplementedError
-        return log_softmax, hidden, attn_weights
+        embedded = self.dropout(self.embedding(input.view(-1)))
+        h, c = self.lstm(embedded, hidden)
+
+        scores = torch.bmm(encoder_outputs, self.attn(h).unsqueeze(2)).squeeze(2)
+        if mask is not None:
+            scores = scores.masked_fill(mask == 0, float('-inf'))
+        attn_weights = F.softmax(scores, dim=1)
+        context = torch.bmm(attn_weights.unsqueeze(1), encoder_outputs).squeeze(1)
 
-    def get_initial_hidden_state(self):
-        return torch.zeros(1, 1, self.hidden_size, device=device)
+        output = torch.tanh(self.attn_combine(torch.cat((h, context), 1)))
+        log_softmax = F.log_softmax(self.out(output), dim=1)
+        return log_softmax, (h, c), attn_weights
+
+    def get_initial_hidden_state(self, batch_size=1):
+        return (torch.zeros(batch_size, self.hidden_size, device=device),
+                torch.zeros(batch_size, self.hidden_size, device=device))
 
 
 ######################################################################
 
 def train(input_tensor, target_tensor, encoder, decoder, optimizer, criterion, max_length=MAX_LENGTH):
-    encoder_hidden = encoder.get_initial_hidden_state()
+    """trains on one pair of (len, 1) tensors, as a batch of one
+    """
+    input_tensor = input_tensor.view(1, -1)
+    target_tensor = target_tensor.view(1, -1)
+    return train_batch(input_tensor, torch.ones(input_tensor.size(), device=device),
+                       target_tensor, torch.ones(target_tensor.size(), device=device),
+                       encoder, decoder, optimizer, criterion)
+
+
+def train_batch(input_tensor, input_mask, target_tensor, target_mask, encoder, decoder, optimizer, criterion):
+    """trains on a padded (batch, seq) minibatch with teacher forcing.
+    criterion must not reduce (reduction='none'), so that padding can be
+    masked out of the loss. returns the loss per target word
+    """
+    encoder_hidden = encoder.get_initial_hidden_state(input_tensor.size(0))
 
     # make sure the encoder and decoder are in training mode so dropout is applied
     encoder.train()
     decoder.train()
 
-    "*** YOUR CODE HERE ***"
-    raise NotImplementedError
+    optimizer.zero_grad()
+    encoder_outputs, decoder_hidden = encoder(input_tensor, encoder_hidden, input_mask)
+
+    decoder_input = torch.full((input_tensor.size(0),), SOS_index, dtype=torch.long, device=device)
+    loss = 0
+    for di in range(target_tensor.size(1)):
+        decoder_output, decoder_hidden, _ = decoder(
+            decoder_input, decoder_hidden, encoder_outputs, input_mask)
+        loss = loss + (criterion(decoder_output, target_tensor[:, di]) * target_mask[:, di]).sum()
+        decoder_input = target_tensor[:, di]
+    loss = loss / target_mask.sum()
+
+    loss.backward()
+    optimizer.step()
 
     return loss.item() 
 
@@ -226,28 +472,23 @@ def translate(encoder, decoder, sentence, src_vocab, tgt_vocab, max_length=MAX_L
     decoder.eval()
 
     with torch.no_grad():
-        input_tensor = tensor_from_sentence(src_vocab, sentence)
-        input_length = input_tensor.size()[0]
+        input_tensor = tensor_from_sentence(src_vocab, sentence).view(1, -1)
+        input_length = input_tensor.size()[1]
         encoder_hidden = encoder.get_initial_hidden_state()
 
-        encoder_outputs = torch.zeros(max_length, encoder.hidden_size, device=device)
-
-        for ei in range(input_length):
-            encoder_output, encoder_hidden = encoder(input_tensor[ei],
-                                                     encoder_hidden)
-            encoder_outputs[ei] += encoder_output[0, 0]
+        encoder_outputs, encoder_hidden = encoder(input_tensor, encoder_hidden)
 
-        decoder_input = torch.tensor([[SOS_index]], device=device)
+        decoder_input = torch.tensor([SOS_index], device=device)
 
         decoder_hidden = encoder_hidden
 
         decoded_words = []
-        decoder_attentions = torch.zeros(max_length, max_length)
+        decoder_attentions = torch.zeros(max_length, input_length)
 
         for di in range(max_length):
             decoder_output, decoder_hidden, decoder_attention = decoder(
                 decoder_input, decoder_hidden, encoder_outputs)
-            decoder_attentions[di] = decoder_attention.data
+            decoder_attentions[di] = decoder_attention.data[0]
             topv, topi = decoder_output.data.topk(1)
             if topi.item() == EOS_index:
                 decoded_words.append(EOS_token)
@@ -255,23 +496,105 @@ def translate(encoder, decoder, sentence, src_vocab, tgt_vocab, max_length=MAX_L
             else:
                 decoded_words.append(tgt_vocab.index2word[topi.item()])
 
-            decoder_input = topi.squeeze().detach()
+            decoder_input = topi.view(1).detach()
 
         return decoded_words, decoder_attentions[:di + 1]
 
 
-######################################################################
+def beam_search(encoder, decoder, input_tensor, input_mask, beam_size=1, length_penalty=1.0, max_length=MAX_LENGTH):
+    """translates a padded (batch, seq) batch of sentences together.
+    the sentences are encoded once, and every step extends the beam_size
+    best hypotheses of each sentence with one batched decoder call.
+    a hypothesis ending in EOS is finished, scored by its logprob / length ** length_penalty,
+    and a sentence leaves the batch once it has beam_size finished hypotheses.
+    returns the word indexes of the best hypothesis of each sentence
+    (with beam_size 1 this is greedy decoding, like translate())
+    """
+    # switch the encoder and decoder to eval mode so they are not applying dropout
+    encoder.eval()
+    decoder.eval()
 
-# Translate (dev/test)set takes in a list of sentences and writes out their transaltes
-def translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab, max_num_sentences=None, max_length=MAX_LENGTH):
-    output_sentences = []
-    for pair in pairs[:max_num_sentences]:
-        output_words, attentions = translate(encoder, decoder, pair[0], src_vocab, tgt_vocab)
-        output_sentence = ' '.join(output_words)
-        output_sentences.append(output_sentence)
+    with torch.no_grad():
+        batch_size = input_tensor.size(0)
+        encoder_outputs, (h, c) = encoder(input_tensor, encoder.get_initial_hidden_state(batch_size), input_mask)
+
+        # row b * beam_size + k holds hypothesis k of the b-th sentence still in the batch
+        rows = torch.arange(batch_size, device=device).repeat_interleave(beam_size)
+        encoder_outputs, input_mask, h, c = encoder_outputs[rows], input_mask[rows], h[rows], c[rows]
+        scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+        scores[:, 0] = 0  # all hypotheses start out the same, so only one is kept
+        words = torch.zeros(batch_size * beam_size, 0, dtype=torch.long, device=device)
+        decoder_input = torch.full((batch_size * beam_size,), SOS_index, dtype=torch.long, device=device)
+        active = list(range(batch_size))
+        finished = [[] for _ in range(batch_size)]
+
+        for di in range(max_length):
+            decoder_output, (h, c), _ = decoder(decoder_input, (h, c), encoder_outputs, input_mask)
+            vocab_size = decoder_output.size(1)
+            candidates = (scores.view(-1, 1) + decoder_output).view(len(active), -1)
+            # among the 2 * beam_size best extensions there are always beam_size that do not end in EOS
+            top_scores, top = candidates.topk(min(2 * beam_size, candidates.size(1)), dim=1)
+            tokens = top % vocab_size
+            beams = top // vocab_size
+            is_eos = tokens == EOS_index
+
+            for b, j in (is_eos[:, :beam_size] & (top_scores[:, :beam_size] > float('-inf'))).nonzero().tolist():
+                hypothesis = words[b * beam_size + beams[b, j]].tolist() + [EOS_index]
+                finished[active[b]].append((top_scores[b, j].item() / (di + 1) ** length_penalty, hypothesis))
+
+            keep = torch.argsort(is_eos.long() * top.size(1) + torch.arange(top.size(1), device=device), dim=1)[:, :beam_size]
+            scores = top_scores.gather(1, keep)
+            decoder_input = tokens.gather(1, keep).view(-1)
+            rows = (torch.arange(len(active), device=device).unsqueeze(1) * beam_size + beams.gather(1, keep)).view(-1)
+            words = torch.cat((words[rows], decoder_input.unsqueeze(1)), 1)
+            h, c = h[rows], c[rows]
+
+            # remove the sentences that are done from the batch
+            still = [b for b, s in enumerate(active) if len(finished[s]) < beam_size]
+            if len(still) < len(active):
+                active = [active[b] for b in still]
+                if not active:
+                    break
+                sentences = torch.tensor(still, device=device)
+                rows = (sentences.unsqueeze(1) * beam_size + torch.arange(beam_size, device=device)).view(-1)
+                scores, words, decoder_input = scores[sentences], words[rows], decoder_input[rows]
+                h, c, encoder_outputs, input_mask = h[rows], c[rows], encoder_outputs[rows], input_mask[rows]
+
+        # sentences still unfinished after max_length words keep their best hypotheses too
+        for b, s in enumerate(active):
+            for k in range(beam_size):
+                if scores[b, k] > float('-inf'):
+                    finished[s].append((scores[b, k].item() / max_length ** length_penalty,
+                                        words[b * beam_size + k].tolist()))
+
+        return [max(hypotheses, key=lambda hypothesis: hypothesis[0])[1] for hypotheses in finished]
+
+
+def translate_dataset(encoder, decoder, data, tgt_vocab, max_num_sentences=None, max_length=MAX_LENGTH,
+                      beam_size=1, length_penalty=1.0, batch_size=64):
+    """translates the source sentences of a Dataset in batches of similar
+    length, returns the output sentences in order
+    """
+    n = len(data) if max_num_sentences is None else min(max_num_sentences, len(data))
+    order = torch.cat(data.buckets) if data.buckets else torch.zeros(0, dtype=torch.long)
+    order = order[order < n]
+    output_sentences = [None] * n
+    for positions in torch.split(order, batch_size):
+        input_tensor, input_mask = data.sources(positions)
+        output = beam_search(encoder, decoder, input_tensor, input_mask, beam_size, length_penalty, max_length)
+        for position, indexes in zip(positions.tolist(), output):
+            output_sentences[position] = ' '.join(tgt_vocab.index2word[i] for i in indexes)
     return output_sentences
 
 
+# Translate (dev/test)set takes in a list of sentences and writes out their transaltes
+def translate_sentences(encoder, decoder, pairs, src_vocab, tgt_vocab, max_num_sentences=None, max_length=MAX_LENGTH,
+                        beam_size=1, length_penalty=1.0, batch_size=64):
+    data = Dataset.from_pairs(pairs[:max_num_sentences], src_vocab, tgt_vocab)
+    return translate_dataset(encoder, decoder, data, tgt_vocab, max_length=max_length,
+                             beam_size=beam_size, length_penalty=length_penalty, batch_size=batch_size)
+
+
 ######################################################################
 # We can translate random sentences  and print out the
 # input, target, and output to make some subjective quality judgements:
@@ -290,23 +613,31 @@ def translate_random_sentence(encoder, decoder, pairs, src_vocab, tgt_vocab, n=1
 
 ######################################################################
 
-def show_attention(input_sentence, output_words, attentions):
-    """visualize the attention mechanism. And save it to a file. 
-    Plots should look roughly like this: https://i.stack.imgur.com/PhtQi.png
-    You plots should include axis labels and a legend.
-    you may want to use matplotlib.
+def show_attention(input_sentence, output_words, attentions, filename='attention.png'):
+    """plots the attention of each output word (rows) over the input words
+    and EOS (columns) as a heatmap with a colorbar, and saves it to filename
     """
-    
-    "*** YOUR CODE HERE ***"
-    raise NotImplementedError
-
-
-def translate_and_show_attention(input_sentence, encoder1, decoder1, src_vocab, tgt_vocab):
+    input_words = input_sentence.split() + [EOS_token]
+    fig, ax = plt.subplots(figsize=(1 + 0.5 * len(input_words), 1 + 0.5 * len(output_words)))
+    image = ax.matshow(attentions.numpy(), cmap='bone', vmin=0, vmax=1)
+    fig.colorbar(image, ax=ax, label='attention weight')
+    ax.set_xticks(range(len(input_words)), input_words, rotation=90)
+    ax.set_yticks(range(len(output_words)), output_words)
+    ax.set_xlabel('input')
+    ax.set_ylabel('output')
+    fig.savefig(filename, bbox_inches='tight')
+    plt.close(fig)
+
+
+def translate_and_show_attention(input_sentence, encoder1, decoder1, src_vocab, tgt_vocab,
+                                 filename='attention.png'):
     output_words, attentions = translate(
         encoder1, decoder1, input_sentence, src_vocab, tgt_vocab)
     print('input =', input_sentence)
     print('output =', ' '.join(output_words))
-    show_attention(input_sentence, output_words, attentions)
+    # unknown subwords are skipped by the encoder, so they get no column
+    known = ' '.join(word for word in input_sentence.split() if word in src_vocab.word2index)
+    show_attention(known, output_words, attentions, filename)
 
 
 def clean(strx):
@@ -317,6 +648,128 @@ def clean(strx):
     return ' '.join(strx.replace('@@ ', '').replace(EOS_token, '').strip().split())
 
 
+######################################################################
+
+def snapshot(state):
+    """copies every tensor in a (nested) state dict to new CPU memory, so the
+    copy is unaffected by later training steps
+    """
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def vocab_file(src_vocab, tgt_vocab):
+    """the vocabs as a checkpoint stores them, and the name of their file,
+    which is named after a hash of its content so that checkpoints made with
+    different data in the same directory never share a vocab file
+    """
+    vocabs = {'src_vocab': src_vocab.state_dict(), 'tgt_vocab': tgt_vocab.state_dict()}
+    digest = hashlib.sha1(json.dumps(vocabs, sort_keys=True).encode('utf-8')).hexdigest()
+    return vocabs, 'vocab_%s.pt' % digest
+
+
+class CheckpointWriter:
+    """writes checkpoints on a background thread, so training only stops
+    for the in-memory snapshot. each file is written under a temporary
+    name and renamed into place, so a checkpoint file is always complete.
+    only the last keep checkpoints (0 = all) this writer wrote are kept;
+    files it did not write, such as the checkpoint training resumed from,
+    are never deleted. the vocabs are written
+    once, to a file named by vocab_file(), and checkpoints refer to it.
+    if a write fails, the error is raised by the next save() or by close()
+    """
+    def __init__(self, directory, src_vocab, tgt_vocab, keep=5):
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        self.written = []
+        self.error = None
+        # at most one checkpoint waits while another is written
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        vocabs, self.vocab_file = vocab_file(src_vocab, tgt_vocab)
+        if not os.path.exists(os.path.join(directory, self.vocab_file)):
+            self._put((self.vocab_file, vocabs, False))
+
+    def save(self, filename, state):
+        """queues a snapshot of state to be written to filename in directory
+        """
+        state = dict(snapshot(state), vocab_file=self.vocab_file)
+        self._put((filename, state, True))
+
+    def close(self):
+        """waits for the queued checkpoints to be written
+        """
+        self._put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+        if not self.thread.is_alive():
+            raise RuntimeError('the checkpoint writer has stopped')
+
+    def _put(self, item):
+        # never wait on a writer that has failed
+        while True:
+            self._check()
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            filename, state, rotate = item
+            path = os.path.join(self.directory, filename)
+            try:
+                start = time.time()
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                logging.debug('wrote checkpoint to %s in %.2fs', path, time.time() - start)
+                if rotate:
+                    if path in self.written:
+                        self.written.remove(path)
+                    self.written.append(path)
+                    while self.keep and len(self.written) > self.keep:
+                        os.remove(self.written.pop(0))
+            except Exception as e:
+                logging.error('could not write checkpoint %s: %s', path, e)
+                self.error = e
+                break
+
+
+def load_checkpoint(filename):
+    """returns a checkpoint written by CheckpointWriter, with the vocabs from
+    its vocab file (in the same directory) as Vocab objects. older checkpoints,
+    which pickled their vocabs or did not name their vocab file, raise ValueError
+    """
+    try:
+        state = torch.load(filename, weights_only=True)
+    except pickle.UnpicklingError:
+        state = {}
+    if 'vocab_file' not in state:
+        raise ValueError('%s is not a checkpoint of this version of seq2seq.py, which stores the '
+                         'name of its vocab file; retrain from scratch to resume from checkpoints'
+                         % filename)
+    vocabs = torch.load(os.path.join(os.path.dirname(filename), state['vocab_file']), weights_only=True)
+    state['src_vocab'] = Vocab.from_state_dict(vocabs['src_vocab'])
+    state['tgt_vocab'] = Vocab.from_state_dict(vocabs['tgt_vocab'])
+    return state
+
+
 ######################################################################
 
 def main():
@@ -329,8 +782,16 @@ def main():
                     help='print loss info every this many training examples')
     ap.add_argument('--checkpoint_every', default=10000, type=int,
                     help='write out checkpoint every this many training examples')
+    ap.add_argument('--checkpoint_dir', default='.',
+                    help='directory for the checkpoints and the vocab file they share')
+    ap.add_argument('--keep_checkpoints', default=5, type=int,
+                    help='number of most recent checkpoints of this run to keep (0 keeps all); ' +
+                         'files from other runs are never deleted')
     ap.add_argument('--initial_learning_rate', default=0.001, type=int,
                     help='initial learning rate')
+    ap.add_argument('--batch_size', default=1, type=int,
+                    help='number of examples per update; above 1, training pairs are ' +
+                         'drawn from buckets of the same length and trained on in padded minibatches')
     ap.add_argument('--src_lang', default='fr',
                     help='Source (input) language code, e.g. "fr"')
     ap.add_argument('--tgt_lang', default='en',
@@ -347,27 +808,41 @@ def main():
                          ' (for test, target is ignored)')
     ap.add_argument('--out_file', default='out.txt',
                     help='output file for test translations')
+    ap.add_argument('--beam_size', default=5, type=int,
+                    help='beam size for translating the dev and test sets (1 is greedy)')
+    ap.add_argument('--length_penalty', default=1.0, type=float,
+                    help='finished translations are ranked by logprob / length ** length_penalty')
+    ap.add_argument('--translate_batch_size', default=64, type=int,
+                    help='number of sentences translated together')
+    ap.add_argument('--torchscript', action='store_true',
+                    help='compile the encoder LSTM loop with TorchScript')
     ap.add_argument('--load_checkpoint', nargs=1,
                     help='checkpoint file to start from')
+    ap.add_argument('--data_cache', default=None,
+                    help='cache of the vocabs and the indexed train/dev/test data, ' +
+                         'rebuilt whenever the data files change ' +
+                         '(default=<train_file>.cache.pt, "" to disable)')
 
     args = ap.parse_args()
+    if args.data_cache is None:
+        args.data_cache = args.train_file + '.cache.pt'
 
     # process the training, dev, test files
 
     # Create vocab from training data, or load if checkpointed
     # also set iteration 
     if args.load_checkpoint is not None:
-        state = torch.load(args.load_checkpoint[0])
+        state = load_checkpoint(args.load_checkpoint[0])
         iter_num = state['iter_num']
         src_vocab = state['src_vocab']
         tgt_vocab = state['tgt_vocab']
     else:
         iter_num = 0
-        src_vocab, tgt_vocab = make_vocabs(args.src_lang,
-                                           args.tgt_lang,
-                                           args.train_file)
+        src_vocab, tgt_vocab = None, None
+    # the data is indexed once, and cached, with the same vocab
+    src_vocab, tgt_vocab, train_data, dev_data, test_data = load_data(args, src_vocab, tgt_vocab)
 
-    encoder = EncoderRNN(src_vocab.n_words, args.hidden_size).to(device)
+    encoder = EncoderRNN(src_vocab.n_words, args.hidden_size, script=args.torchscript).to(device)
     decoder = AttnDecoderRNN(args.hidden_size, tgt_vocab.n_words, dropout_p=0.1).to(device)
 
     # encoder/decoder weights are randomly initilized
@@ -377,73 +852,100 @@ def main():
         decoder.load_state_dict(state['dec_state'])
 
     # read in datafiles
-    train_pairs = split_lines(args.train_file)
     dev_pairs = split_lines(args.dev_file)
-    test_pairs = split_lines(args.test_file)
 
     # set up optimization/loss
     params = list(encoder.parameters()) + list(decoder.parameters())  # .parameters() returns generator
     optimizer = optim.Adam(params, lr=args.initial_learning_rate)
-    criterion = nn.NLLLoss()
+    criterion = nn.NLLLoss(reduction='none')
 
     # optimizer may have state
     # if checkpointed, load saved state
     if args.load_checkpoint is not None:
         optimizer.load_state_dict(state['opt_state'])
 
+    batches = []
+    writer = CheckpointWriter(args.checkpoint_dir, src_vocab, tgt_vocab, args.keep_checkpoints)
+
     start = time.time()
     print_loss_total = 0  # Reset every args.print_every
+    print_examples = 0
+    print_tokens = 0
+    print_start = time.time()
 
     while iter_num < args.n_iters:
-        iter_num += 1
-        training_pair = tensors_from_pair(src_vocab, tgt_vocab, random.choice(train_pairs))
-        input_tensor = training_pair[0]
-        target_tensor = training_pair[1]
-        loss = train(input_tensor, target_tensor, encoder,
-                     decoder, optimizer, criterion)
-        print_loss_total += loss
-
-        if iter_num % args.checkpoint_every == 0:
+        if args.batch_size > 1:
+            if not batches:
+                batches = train_data.make_batches(args.batch_size)
+            batch = batches.pop()
+        else:
+            batch = torch.tensor([random.randrange(len(train_data))])
+        input_tensor, input_mask, target_tensor, target_mask = train_data.batch(batch)
+        loss = train_batch(input_tensor, input_mask, target_tensor, target_mask,
+                           encoder, decoder, optimizer, criterion)
+        examples = len(batch)
+        tokens = int(input_mask.sum().item() + target_mask.sum().item())
+        last_iter_num = iter_num
+        iter_num += examples
+        print_loss_total += loss * examples
+        print_examples += examples
+        print_tokens += tokens
+
+        # with minibatches, iter_num can step over a multiple of checkpoint_every
+        if iter_num // args.checkpoint_every > last_iter_num // args.checkpoint_every:
+            checkpoint_start = time.time()
             state = {'iter_num': iter_num,
                      'enc_state': encoder.state_dict(),
                      'dec_state': decoder.state_dict(),
                      'opt_state': optimizer.state_dict(),
-                     'src_vocab': src_vocab,
-                     'tgt_vocab': tgt_vocab,
                      }
             filename = 'state_%010d.pt' % iter_num
-            torch.save(state, filename)
-            logging.debug('wrote checkpoint to %s', filename)
+            writer.save(filename, state)
+            logging.debug('queued checkpoint %s, training paused %.3fs', filename, time.time() - checkpoint_start)
 
-        if iter_num % args.print_every == 0:
-            print_loss_avg = print_loss_total / args.print_every
+        if iter_num // args.print_every > last_iter_num // args.print_every:
+            print_loss_avg = print_loss_total / print_examples
+            tokens_per_sec = print_tokens / (time.time() - print_start)
             print_loss_total = 0
-            logging.info('time since start:%s (iter:%d iter/n_iters:%d%%) loss_avg:%.4f',
+            print_examples = 0
+            print_tokens = 0
+            logging.info('time since start:%s (iter:%d iter/n_iters:%d%%) loss_avg:%.4f tokens/sec:%.0f',
                          time.time() - start,
                          iter_num,
                          iter_num / args.n_iters * 100,
-                         print_loss_avg)
+                         print_loss_avg,
+                         tokens_per_sec)
             # translate from the dev set
             translate_random_sentence(encoder, decoder, dev_pairs, src_vocab, tgt_vocab, n=2)
-            translated_sentences = translate_sentences(encoder, decoder, dev_pairs, src_vocab, tgt_vocab)
+            translated_sentences = translate_dataset(encoder, decoder, dev_data, tgt_vocab,
+                                                     beam_size=args.beam_size,
+                                                     length_penalty=args.length_penalty,
+                                                     batch_size=args.translate_batch_size)
 
             references = [[clean(pair[1]).split(), ] for pair in dev_pairs[:len(translated_sentences)]]
             candidates = [clean(sent).split() for sent in translated_sentences]
             dev_bleu = corpus_bleu(references, candidates)
             logging.info('Dev BLEU score: %.2f', dev_bleu)
+            print_start = time.time()
+
+    writer.close()
 
     # translate test set and write to file
-    translated_sentences = translate_sentences(encoder, decoder, test_pairs, src_vocab, tgt_vocab)
+    translated_sentences = translate_dataset(encoder, decoder, test_data, tgt_vocab,
+                                             beam_size=args.beam_size,
+                                             length_penalty=args.length_penalty,
+                                             batch_size=args.translate_batch_size)
     with open(args.out_file, 'wt', encoding='utf-8') as outf:
         for sent in translated_sentences:
             outf.write(clean(sent) + '\n')
 
-    # Visualizing Attention
-    translate_and_show_attention("on p@@ eu@@ t me faire confiance .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("j en suis contente .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("vous etes tres genti@@ ls .", encoder, decoder, src_vocab, tgt_vocab)
-    translate_and_show_attention("c est mon hero@@ s ", encoder, decoder, src_vocab, tgt_vocab)
-
+    # Visualizing Attention, saved next to the test translations
+    for i, sentence in enumerate(["on p@@ eu@@ t me faire confiance .",
+                                  "j en suis contente .",
+                                  "vous etes tres genti@@ ls .",
+                                  "c est mon hero@@ s "]):
+        translate_and_show_attention(sentence, encoder, decoder, src_vocab, tgt_vocab,
+                                     '%s.attention%d.png' % (os.path.splitext(args.out_file)[0], i + 1))
 
 if __name__ == '__main__':
     main()